@@ -0,0 +1,233 @@
+#-*-coding:utf-8 -*-
+#
+# asyncio variant of K_Line / DS2 / KWP2000 - one event loop drives any
+# number of adapters next to other services, no thread per cable.
+#
+#   async def main():
+#       dme = AsyncME72("/dev/ttyUSB0")
+#       egs = AsyncZF5HP24(bus=dme)
+#       reply = await dme.execute(DME, 0xf1, b'\x22\x40\x00')
+#       async for timestamp, request, values in egs.samples([b'\x0B\x03'], cycles=10):
+#           print(values['gear'])
+#
+# Framing, checksums and reply checks are the ones of ds2.py, only the
+# port handling differs: the port is opened non-blocking and the loop is
+# told when it is readable (POSIX only, the serial file descriptor is used).
+#
+
+import asyncio
+import logging
+import time
+
+import serial
+
+import ds2
+import stats
+from ds2 import DEFAULT_PORT, DEFAULT_BAUDRATE, ProtocolError, ChecksumError
+
+class AsyncFrameReader(object):
+    def __init__(self, device):
+        self._device = device
+        self._buffer = bytearray()
+        self._waiter = None
+        self._loop = None
+
+    def _attach(self):
+        if self._loop is None:
+            self._loop = asyncio.get_running_loop()
+            self._loop.add_reader(self._device.fileno(), self._on_readable)
+
+    def close(self):
+        if self._loop is not None:
+            self._loop.remove_reader(self._device.fileno())
+            self._loop = None
+
+    def reset(self):
+        del self._buffer[:]
+
+    def _on_readable(self):
+        data = self._device.read(self._device.in_waiting or 1)
+        if data:
+            self._buffer += data
+            if self._waiter is not None and not self._waiter.done():
+                self._waiter.set_result(None)
+
+    async def _wait(self, timeout):
+        self._waiter = self._loop.create_future()
+        try:
+            await asyncio.wait_for(self._waiter, timeout)
+            return True
+        except asyncio.TimeoutError:
+            return False
+        finally:
+            self._waiter = None
+
+    async def read_frame(self, frame_length, timing):
+        """ Same contract as FrameReader.read_frame, the frame is a bytes copy """
+        self._attach()
+        while True:
+            try:
+                size = frame_length(self._buffer, 0, len(self._buffer))
+            except ProtocolError:
+                self.reset()
+                raise
+            if size is not None and size <= len(self._buffer):
+                frame = bytes(self._buffer[:size])
+                del self._buffer[:size]
+                return frame
+            if not self._buffer:
+                timeout = timing.p2_max
+            else:
+                # Mid-frame, one byte on the wire plus the inter-byte gap
+                timeout = 11.0 / self._device.baudrate + timing.p1_max
+            if not await self._wait(timeout):
+                self.reset()
+                return None
+
+class AsyncPacer(ds2.Pacer):
+    async def wait(self, gap):
+        now = time.monotonic()
+        if self._started is None:
+            self._started = now
+        if self._done + gap > now:
+            await asyncio.sleep(self._done + gap - now)
+
+class AsyncK_Line(object):
+    TIMING = ds2.K_Line.TIMING
+    TELEGRAMS = {}
+
+    _checksum = ds2.K_Line._checksum
+
+    def __init__(self, port=DEFAULT_PORT, bus=None, parity=serial.PARITY_EVEN):
+        self.timing = self.TIMING.copy()
+        if bus is None:
+            self._device = serial.Serial(port, DEFAULT_BAUDRATE, parity=parity, timeout=0)
+            self._reader = AsyncFrameReader(self._device)
+            self.pacer = AsyncPacer()
+            self.stats = stats.Stats()
+            # One transaction on the wire at a time, whoever awaits
+            self._lock = asyncio.Lock()
+        else:
+            self._device = bus._device
+            self._reader = bus._reader
+            self.pacer = bus.pacer
+            self.stats = bus.stats
+            self._lock = bus._lock
+
+    def close(self):
+        self._reader.close()
+        self._device.close()
+
+    async def _send(self, p):
+        if self.timing.p4_min > 0:
+            for i in range(len(p)):
+                self._device.write(p[i:i + 1])
+                await asyncio.sleep(self.timing.p4_min)
+        else:
+            self._device.write(p)
+        self.stats.sent(len(p))
+
+    async def _read(self):
+        p = await self._reader.read_frame(self._frame_length, self.timing)
+        if p is None:
+            return None
+        self.stats.received(len(p))
+        if ds2.logger.isEnabledFor(logging.DEBUG):
+            ds2.logger.debug("RX : " + ''.join('{:02x} '.format(x) for x in p))
+        if p[-1] != self._checksum(p[:-1]):
+            raise ChecksumError("invalid checksum")
+        return p
+
+    async def _transfer(self, p, address, service):
+        async with self._lock:
+            await self.pacer.wait(self.timing.p3_min)
+            reply = None
+            try:
+                if ds2.logger.isEnabledFor(logging.DEBUG):
+                    ds2.logger.debug("TX : " + ''.join('{:02x} '.format(x) for x in p))
+                await self._send(p)
+                sent = time.perf_counter()
+                try:
+                    echo = await self._read()
+                    echoed = time.perf_counter()
+                    reply = await self._read()
+                except ChecksumError:
+                    self.stats.checksum_error(address, service)
+                    raise
+                replied = time.perf_counter()
+                self.stats.transaction(address, service, sent, None if echo is None else echoed,
+                                       None if reply is None else replied, self._status(reply))
+            finally:
+                self.pacer.done(reply is not None)
+        return reply
+
+    async def samples(self, requests, cycles=None):
+        """ async iterator of (timestamp, request, { channel : value }) decoded with TELEGRAMS """
+        cycle = 0
+        while cycles is None or cycle < cycles:
+            for request in requests:
+                request = bytes(request)
+                reply = await self.query(request)
+                table = self.TELEGRAMS[request]
+                values = [None] * len(table.channels) if reply is None else table.decode(reply)
+                yield time.time(), request, dict((c.name, v) for c, v in zip(table.channels, values))
+            cycle += 1
+
+class AsyncDS2(AsyncK_Line):
+    TIMING = ds2.DS2.TIMING
+    ADDRESS = None
+
+    _frame = ds2.DS2._frame
+    _frame_length = ds2.DS2._frame_length
+    _check = ds2.DS2._check
+    _status = ds2.DS2._status
+
+    async def execute(self, address, payload, verbose=True):
+        reply = await self._transfer(self._frame(address, payload), address, payload[0])
+        return self._check(address, reply, verbose)
+
+    async def query(self, payload):
+        return await self.execute(self.ADDRESS, payload, verbose=False)
+
+class AsyncKWP2000(AsyncK_Line):
+    TIMING = ds2.KWP2000.TIMING
+    ADDRESS = None
+    SOURCE = 0xf1
+
+    _frame = ds2.KWP2000._frame
+    _frame_length = ds2.KWP2000._frame_length
+    _check = ds2.KWP2000._check
+    _status = ds2.KWP2000._status
+
+    async def execute(self, address, source, payload, verbose=True):
+        reply = await self._transfer(self._frame(address, source, payload), address, payload[0])
+        return self._check(address, reply, verbose)
+
+    async def query(self, payload):
+        return await self.execute(self.ADDRESS, self.SOURCE, payload, verbose=False)
+
+class AsyncME72(AsyncKWP2000):
+    ADDRESS = ds2.DME
+    TELEGRAMS = ds2.ME72_TELEGRAMS
+
+class AsyncZF5HP24(AsyncDS2):
+    ADDRESS = ds2.EGS
+    TELEGRAMS = ds2.ZF5HP24_TELEGRAMS
+
+if __name__ == '__main__':
+    async def main():
+        dme = AsyncME72()
+        egs = AsyncZF5HP24(bus=dme)
+
+        async def show(ecu, requests):
+            async for timestamp, request, values in ecu.samples(requests, cycles=10):
+                print("{:.3f} ".format(timestamp) + ', '.join(k + "=" + str(v) for k, v in sorted(values.items())))
+
+        try:
+            await asyncio.gather(show(dme, [b'\x22\x40\x00']), show(egs, [b'\x0B\x03']))
+        finally:
+            dme.close()
+        print(dme.pacer.summary())
+        print(dme.stats.dump())
+
+    asyncio.run(main())
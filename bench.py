@@ -0,0 +1,288 @@
+#-*-coding:utf-8 -*-
+#
+# Benchmarks - framing, checksum, per telegram decode and end to end polling
+#
+#   python bench.py                     # everything, results in bench.json
+#   python bench.py --output 1.2.json --skip-pty
+#
+# Micro benchmarks report the best of several runs in ns per call. End to
+# end runs go through the emulator models, once over an in-memory loopback
+# (software cost only, no pacing) and once over the pty emulator with real
+# timing (samples/sec and latency percentiles).
+#
+# The sniffer run doubles as a check, clean random traffic has to come out
+# of the parser frame for frame in any read size, it raises otherwise.
+#
+
+import contextlib
+import json
+import os
+import platform
+import random
+import subprocess
+import time
+import timeit
+
+import ds2
+import emulator
+import sniffer
+import stats
+
+class Loopback(object):
+    """ In-memory K-line, echo plus the emulator models, no sleeps """
+    def __init__(self, models=None):
+        if models is None:
+            models = [emulator.ME72Model(), emulator.ZF5HP24Model()]
+        self.models = dict((model.ADDRESS, model) for model in models)
+        self.baudrate = ds2.DEFAULT_BAUDRATE
+        self.timeout = None
+        self.inter_byte_timeout = None
+        self._rx = bytearray()
+
+    @property
+    def in_waiting(self):
+        return len(self._rx)
+
+    def write(self, data):
+        self._rx += data
+        reply = emulator.respond(self.models, bytes(data))
+        if reply is not None:
+            self._rx += reply
+        return len(data)
+
+    def read(self, size=1):
+        data = bytes(self._rx[:size])
+        del self._rx[:size]
+        return data
+
+    def flush(self):
+        pass
+
+class Replay(object):
+    """ Endless stream of the same frames for the frame reader """
+    def __init__(self, frames, count):
+        self.data = b''.join(frames) * count
+        self.baudrate = ds2.DEFAULT_BAUDRATE
+        self.timeout = None
+        self.inter_byte_timeout = None
+        self._position = 0
+
+    @property
+    def in_waiting(self):
+        return len(self.data) - self._position
+
+    def read(self, size=1):
+        data = self.data[self._position:self._position + size]
+        self._position += len(data)
+        return data
+
+    def rewind(self):
+        self._position = 0
+
+class Bus(object):
+    """ What K_Line(bus=...) shares, around any device """
+    def __init__(self, device):
+        self._device = device
+        self._reader = ds2.FrameReader(device)
+        self.pacer = ds2.Pacer()
+        self.stats = stats.Stats()
+
+def _best(func, repeat=3):
+    """ ns per call, best of repeat """
+    timer = timeit.Timer(func)
+    number, elapsed = timer.autorange()
+    return min(timer.repeat(repeat, number)) / number * 1e9
+
+def _percentile(values, p):
+    values = sorted(values)
+    return values[min(int(len(values) * p / 100.0), len(values) - 1)]
+
+def _sample_frames():
+    """ { (ecu, request) : reply frame } for every telegram, recorded frames where there are some """
+    device = Loopback()
+    bus = Bus(device)
+    kwp = ds2.KWP2000(bus=bus)
+    ds = ds2.DS2(bus=bus)
+    result = {}
+    for request in ds2.ME72_TELEGRAMS:
+        result[('DME', request)] = bytes(emulator.respond(device.models, kwp._frame(ds2.DME, 0xf1, request)))
+    for request in ds2.ZF5HP24_TELEGRAMS:
+        result[('EGS', request)] = bytes(emulator.respond(device.models, ds._frame(ds2.EGS, request)))
+    return result
+
+def bench_checksum():
+    result = {}
+    for size in (6, 16, 50):
+        frame = bytes(bytearray(range(size)))
+        result[str(size) + ' bytes'] = { 'ns' : _best(lambda: ds2.K_Line._checksum(None, frame)) }
+    return result
+
+def bench_framing(frames):
+    result = {}
+    kwp = [f for (ecu, request), f in sorted(frames.items()) if ecu == 'DME']
+    ds = [f for (ecu, request), f in sorted(frames.items()) if ecu == 'EGS']
+    for name, protocol, sample in (('kwp2000', ds2.KWP2000, kwp), ('ds2', ds2.DS2, ds)):
+        device = Replay(sample, 200)
+        reader = ds2.FrameReader(device, 4096)
+        count = 200 * len(sample)
+        frame_length = lambda buffer, start, available: protocol._frame_length(None, buffer, start, available)
+
+        def parse():
+            device.rewind()
+            reader.reset()
+            for i in range(count):
+                reader.read_frame(frame_length, ds2.K_Line.TIMING)
+        result[name] = { 'ns' : _best(parse) / count, 'frames' : len(sample) }
+    return result
+
+def bench_decode(frames):
+    result = {}
+    for (ecu, request), frame in sorted(frames.items()):
+        table = (ds2.ME72_TELEGRAMS if ecu == 'DME' else ds2.ZF5HP24_TELEGRAMS)[request]
+        result[ecu + ' ' + request.hex()] = {
+            'ns' : _best(lambda: table.decode(frame)),
+            'channels' : len(table.channels),
+            'bytes' : len(frame),
+        }
+    # Hand written decoders of the replies without a telegram table, their prints go nowhere
+    bus = Bus(Loopback())
+    dme = ds2.ME72(bus=bus)
+    egs = ds2.ZF5HP24(bus=bus)
+    with open(os.devnull, 'w') as null, contextlib.redirect_stdout(null):
+        for name, ecu, replies in (('DME', dme, emulator.DME_REPLIES), ('EGS', egs, emulator.EGS_REPLIES)):
+            for request, reply in sorted(replies.items()):
+                if request in ecu.telegrams:
+                    continue
+                frame = bytes.fromhex(reply)
+                result[name + ' ' + request.hex()] = {
+                    'ns' : _best(lambda: ecu.decode(request, frame)),
+                    'bytes' : len(frame),
+                }
+    return result
+
+def _random_frames(count, seed=1):
+    """ Valid DS2 / KWP2000 frames with random payloads, as a clean bus carries them """
+    generator = random.Random(seed)
+    frames = []
+    for i in range(count):
+        payload = bytes(generator.randrange(256) for j in range(generator.randrange(1, 40)))
+        if generator.random() < 0.5:
+            frame = bytearray([0xb8, ds2.DME, 0xf1, len(payload)]) + payload
+        else:
+            frame = bytearray([ds2.EGS, len(payload) + 3]) + payload
+        frame.append(ds2.K_Line._checksum(None, frame))
+        frames.append(bytes(frame))
+    return frames
+
+def bench_sniffer(count=5000):
+    """ Clean random traffic through the sniffer parser in reads of 1, 4 and 64 bytes, every frame has to come back """
+    frames = _random_frames(count)
+    data = b''.join(frames)
+    result = {}
+    for chunk in (1, 4, 64):
+        monitor = sniffer.Sniffer(bus=Bus(Replay(frames, 1)), capacity=count)
+        byte_time = 11.0 / ds2.DEFAULT_BAUDRATE
+        started = time.perf_counter()
+        for i in range(0, len(data), chunk):
+            monitor._fill(data[i:i + chunk])
+            monitor._parse(0.0, byte_time, None, final=False)
+        elapsed = time.perf_counter() - started
+        received = [frame for timestamp, kind, frame in monitor.take()]
+        if received != frames or monitor.corrupt or monitor.stalled:
+            raise RuntimeError("sniffer in " + str(chunk) + " byte reads : " + monitor.summary() + ", " +
+                               str(sum(a == b for a, b in zip(received, frames))) + " of " + str(count) + " frames intact")
+        result[str(chunk) + ' byte reads'] = { 'ns' : elapsed / count * 1e9, 'frames' : count }
+    return result
+
+def bench_loopback(cycles=2000):
+    bus = Bus(Loopback())
+    dme = ds2.ME72(bus=bus)
+    egs = ds2.ZF5HP24(bus=bus)
+    result = {}
+    for name, ecu, request, table in (('DME 224000', dme, b'\x22\x40\x00', ds2.ME72_TELEGRAMS),
+                                      ('EGS 0b03', egs, b'\x0B\x03', ds2.ZF5HP24_TELEGRAMS)):
+        ecu.timing.p3_min = 0
+        started = time.perf_counter()
+        for i in range(cycles):
+            table[request].decode(ecu.query(request))
+        elapsed = time.perf_counter() - started
+        result[name] = { 'cycles/sec' : cycles / elapsed, 'us' : elapsed / cycles * 1e6 }
+    return result
+
+def bench_pty(requests=100, latency=0.005):
+    import serial
+    emu = emulator.Emulator(latency=latency)
+    emu.start()
+    try:
+        dme = ds2.ME72(port=emu.port, parity=serial.PARITY_NONE)
+        egs = ds2.ZF5HP24(bus=dme)
+        result = {}
+        for name, ecu, request, table in (('DME 224000', dme, b'\x22\x40\x00', ds2.ME72_TELEGRAMS),
+                                          ('EGS 0b03', egs, b'\x0B\x03', ds2.ZF5HP24_TELEGRAMS)):
+            latencies = []
+            failed = 0
+            started = time.perf_counter()
+            for i in range(requests):
+                t = time.perf_counter()
+                reply = ecu.query(request)
+                if reply is None:
+                    failed += 1
+                else:
+                    table[request].decode(reply)
+                latencies.append((time.perf_counter() - t) * 1000)
+            elapsed = time.perf_counter() - started
+            result[name] = {
+                'samples/sec' : (requests - failed) / elapsed,
+                'p50 ms' : _percentile(latencies, 50),
+                'p95 ms' : _percentile(latencies, 95),
+                'p99 ms' : _percentile(latencies, 99),
+                'max ms' : max(latencies),
+                'failed' : failed,
+            }
+        dme._device.close()
+        return result
+    finally:
+        emu.close()
+
+def _revision():
+    try:
+        return subprocess.check_output(['git', 'describe', '--always', '--dirty'],
+                                       cwd=os.path.dirname(os.path.abspath(__file__)),
+                                       stderr=subprocess.DEVNULL).decode('utf-8').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def run(pty=True):
+    frames = _sample_frames()
+    results = {
+        'checksum' : bench_checksum(),
+        'framing' : bench_framing(frames),
+        'decode' : bench_decode(frames),
+        'sniffer' : bench_sniffer(),
+        'loopback' : bench_loopback(),
+    }
+    if pty and hasattr(os, 'openpty'):
+        results['pty'] = bench_pty()
+    return {
+        'revision' : _revision(),
+        'time' : time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python' : platform.python_version(),
+        'platform' : platform.platform(),
+        'results' : results,
+    }
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description="bmw-coding benchmarks")
+    parser.add_argument('--output', default='bench.json')
+    parser.add_argument('--skip-pty', action='store_true', help="no end to end run over the pty emulator")
+    args = parser.parse_args()
+
+    report = run(pty=not args.skip_pty)
+    for group, results in sorted(report['results'].items()):
+        for name, values in sorted(results.items()):
+            print(group + " " + name + " : " + ', '.join(k + " " + "{:.3g}".format(v) for k, v in sorted(values.items())))
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2, sort_keys=True)
+    print("results in " + args.output)
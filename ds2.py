@@ -1,10 +1,23 @@
 #-*-coding:utf-8 -*-
 #from hexdump import hexdump
+import logging
+import os
 import serial
 import time
 
-import struct
-from struct import unpack
+import stats
+import telegram
+
+# TX / RX / RAW frame dumps go to this logger at DEBUG level, they are only
+# formatted when that level is enabled
+logger = logging.getLogger('ds2')
+
+def _problem(message, verbose):
+    # Interactive run() / decode paths print, query() leaves it to the logger
+    if verbose:
+        print(message)
+    else:
+        logger.debug(message)
 
 def byte_to_int(char):
     if char > 127:
@@ -26,9 +39,188 @@ MID = 0xC0 # Multi Information Display
 RADIO = 0x68 # Radio
 SZM = 0xf5 # Center Console Switching Center
 
-class K_Line(object):
+DEFAULT_PORT = "/dev/ttyUSB0"
+DEFAULT_BAUDRATE = 9600
+
+# StartDiagnosticSession baudrate identifiers (ISO 14230-3)
+BAUDRATE_IDS = {
+    9600:       0x01,
+    19200:      0x02,
+    38400:      0x03,
+    57600:      0x04,
+    115200:     0x05
+}
+
+class ProtocolError(Exception):
+    pass
+
+class ChecksumError(ProtocolError):
+    pass
+
+#
+# Timing parameters (ISO 14230-2), all in seconds
+#   P1 - inter byte gap in ECU responses
+#   P2 - end of request to start of response
+#   P3 - end of response to next request
+#   P4 - inter byte gap in tester requests
+#
+
+class Timing(object):
+    def __init__(self, p1_max=0.02, p2_min=0.025, p2_max=0.05, p3_min=0.055, p3_max=5.0, p4_min=0.0):
+        self.p1_max = p1_max
+        self.p2_min = p2_min
+        self.p2_max = p2_max
+        self.p3_min = p3_min
+        self.p3_max = p3_max
+        self.p4_min = p4_min
+
+    def copy(self):
+        return Timing(self.p1_max, self.p2_min, self.p2_max, self.p3_min, self.p3_max, self.p4_min)
+
+    def __repr__(self):
+        return "Timing(p1_max=%g, p2_min=%g, p2_max=%g, p3_min=%g, p3_max=%g, p4_min=%g)" % (
+            self.p1_max, self.p2_min, self.p2_max, self.p3_min, self.p3_max, self.p4_min)
+
+#
+# Frame reader - reads whatever the adapter has into one reusable buffer and
+# hands out complete frames as memoryview slices of it. A slice is only valid
+# until the next read_frame() call, copy it (bytes(frame)) to keep it.
+#
+# The first byte of a frame is waited for up to P2max, after that every
+# byte has to follow within P1max. A frame that stalls mid-payload is
+# dropped after one inter-byte gap instead of blocking the reader.
+#
+
+class FrameReader(object):
+    def __init__(self, device, size=1024):
+        self._device = device
+        self._timing = None
+        self._buffer = bytearray(size)
+        self._view = memoryview(self._buffer)
+        self._start = 0
+        self._end = 0
+        self._timeouts = None
+
+    def reset(self):
+        self._start = 0
+        self._end = 0
+
+    def read_frame(self, frame_length, timing):
+        """ frame_length(buffer, start, available) -> total frame size, None if the header is incomplete """
+        self._timing = timing
+        while True:
+            available = self._end - self._start
+            try:
+                size = frame_length(self._buffer, self._start, available)
+            except ProtocolError:
+                self.reset()
+                raise
+            if size is not None and size <= available:
+                frame = self._view[self._start:self._start + size]
+                self._start += size
+                return frame
+            if not self._fill((size or 0) - available):
+                # Timeout or inter-byte gap, a partial frame is of no use to anyone
+                self.reset()
+                return None
+
+    def _fill(self, needed):
+        if self._start == self._end:
+            self._start = self._end = 0
+        elif len(self._buffer) - self._end < max(needed, 1):
+            # Move the partial frame to the front, frames handed out before are stale now
+            remaining = self._end - self._start
+            self._buffer[0:remaining] = self._buffer[self._start:self._end]
+            self._start, self._end = 0, remaining
+        want = min(max(needed, self._device.in_waiting, 1), len(self._buffer) - self._end)
+        if self._start == self._end:
+            self._set_timeouts(self._timing.p2_max, self._timing.p1_max)
+        else:
+            # Mid-frame, allow the bytes on the wire plus one inter-byte gap
+            byte_time = 11.0 / self._device.baudrate # 8E1
+            self._set_timeouts(want * byte_time + self._timing.p1_max, self._timing.p1_max)
+        data = self._device.read(want)
+        if not data or (self._start != self._end and len(data) < needed):
+            return False
+        self._buffer[self._end:self._end + len(data)] = data
+        self._end += len(data)
+        return True
+
+    def _set_timeouts(self, timeout, inter_byte_timeout):
+        # Changing pyserial timeouts reconfigures the port, only do it when they differ
+        if self._timeouts != (timeout, inter_byte_timeout):
+            self._device.timeout = timeout
+            self._device.inter_byte_timeout = inter_byte_timeout
+            self._timeouts = (timeout, inter_byte_timeout)
+
+#
+# Request pacing - the next request goes out as soon as the previous reply
+# is complete plus the minimum inter-message gap (P3min) of the ECU profile.
+# ECUs sharing a K-line share one pacer.
+#
+
+class Pacer(object):
     def __init__(self):
-        self._device = serial.Serial("/dev/ttyUSB0", 9600, parity=serial.PARITY_EVEN, timeout=0.5)    
+        # Requests sent, the ones that got a reply and the ones that did not
+        self.requests = 0
+        self.replies = 0
+        self.failures = 0
+        self._done = 0.0
+        self._started = None
+
+    def wait(self, gap):
+        now = time.monotonic()
+        if self._started is None:
+            self._started = now
+        if self._done + gap > now:
+            time.sleep(self._done + gap - now)
+
+    def done(self, replied=True):
+        self.requests += 1
+        if replied:
+            self.replies += 1
+        else:
+            self.failures += 1
+        self._done = time.monotonic()
+
+    def rate(self):
+        if self._started is None:
+            return 0.0
+        elapsed = time.monotonic() - self._started
+        return self.replies / elapsed if elapsed > 0 else 0.0
+
+    def summary(self):
+        return str(self.requests) + " requests, " + str(self.failures) + " failed, " + \
+            "{:.1f}".format(self.rate()) + " samples/sec"
+
+class K_Line(object):
+    TIMING = Timing(p2_max=0.5, p3_min=0.2)
+    NAME = None
+    CACHE_SIZE = 256
+    telegrams = {}
+
+    def __init__(self, bus=None, port=DEFAULT_PORT, parity=serial.PARITY_EVEN):
+        self.timing = self.TIMING.copy()
+        self.cache = telegram.DecodeCache(self.CACHE_SIZE)
+        # Only decode / report replies that differ from the previous one to the same request
+        self.changed_only = False
+        self._last = {}
+        if bus is None:
+            self._device = serial.Serial(port, DEFAULT_BAUDRATE, parity=parity, timeout=self.timing.p2_max)
+            self._reader = FrameReader(self._device)
+            self.pacer = Pacer()
+            self.stats = stats.Stats()
+            self._ecus = [self]
+        else:
+            # Another ECU on the same K-line, share its port
+            self._device = bus._device
+            self._reader = bus._reader
+            self.pacer = bus.pacer
+            self.stats = bus.stats
+            self._ecus = getattr(bus, '_ecus', [bus])
+            self._ecus.append(self)
+        if self.NAME is not None:
+            self.stats.names[self.ADDRESS] = self.NAME
 
     def _checksum(self, message):
         result = 0
@@ -36,16 +228,105 @@ class K_Line(object):
             result ^= b
         return result
 
+    def shared(self):
+        """ True if other ECU objects use the same port """
+        return len(self._ecus) > 1
+
+    def _set_baudrate(self, baudrate):
+        self._device.baudrate = baudrate
+        self._reader.reset()
+
+    def _send(self, p):
+        if self.timing.p4_min > 0:
+            for i in range(len(p)):
+                self._device.write(p[i:i + 1])
+                time.sleep(self.timing.p4_min)
+        else:
+            self._device.write(p)
+        # Wait until the request is on the wire, the echo and P2 start from there
+        self._device.flush()
+        self.stats.sent(len(p))
+
+    def _read(self):
+        p = self._reader.read_frame(self._frame_length, self.timing)
+        if p is None:
+            return None
+        self.stats.received(len(p))
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("RX : " + ''.join('{:02x} '.format(x) for x in p))
+            logger.debug("RAW : " + ''.join('\\x{:02x}'.format(x) for x in p))
+        if p[-1] != self._checksum(p[:-1]):
+            raise ChecksumError("invalid checksum")
+        return p
+
+    def _exchange(self, address, service):
+        """ Echo and reply to the request just sent, timed into self.stats """
+        sent = time.perf_counter()
+        try:
+            echo = self._read()
+            echoed = time.perf_counter()
+            reply = self._read()
+        except ChecksumError:
+            self.stats.checksum_error(address, service)
+            raise
+        replied = time.perf_counter()
+        self.stats.transaction(address, service, sent, None if echo is None else echoed,
+                               None if reply is None else replied, self._status(reply))
+        return reply
+
+    def _status(self, reply):
+        return None
+
+    def sniffer(self, handler=None, duration=None):
+        """ Passive monitor on this K-line until interrupted, see sniffer.py """
+        import sniffer
+        monitor = sniffer.Sniffer(bus=self)
+        print("Sniffer ...")
+        monitor.run(handler or sniffer.show, duration)
+        print(monitor.summary())
+        return monitor
+
+    def _report(self, table, reply):
+        for channel, value in zip(table.channels, self.cache.decode(table, reply, self.NAME)):
+            print(channel.label + " : " + channel.format(value))
+
+    def _changed(self, request, reply):
+        reply = bytes(reply)
+        if self._last.get(request) == reply:
+            return False
+        self._last[request] = reply
+        return True
+
+    def samples(self, requests, cycles=None, changed_only=None):
+        """ Sample per decoded channel of every reply, nothing is formatted or printed """
+        changed_only = self.changed_only if changed_only is None else changed_only
+        requests = [bytes(request) for request in requests]
+        cycle = 0
+        while cycles is None or cycle < cycles:
+            for request in requests:
+                reply = self.query(request)
+                timestamp = time.time()
+                if changed_only and reply is not None and not self._changed(request, reply):
+                    continue
+                table = self.telegrams[request]
+                values = [None] * len(table.channels) if reply is None else self.cache.decode(table, reply, self.NAME)
+                for channel, value in zip(table.channels, values):
+                    yield telegram.Sample(self.NAME, channel.name, value, channel.unit, timestamp)
+            cycle += 1
+
 #
 # DS2
 #
 
 class DS2(K_Line):
-    def sniffer(self):
-        print("DS2 sniffer ...")
-        self._read()
+    TIMING = Timing(p2_max=0.1, p3_min=0.02)
+    ADDRESS = None
 
-    def _write(self, address, payload):
+    def query(self, payload):
+        """ Checked reply to payload without decoding it, nothing is printed """
+        return DS2._execute(self, self.ADDRESS, payload, verbose=False)
+
+    def _frame(self, address, payload):
         size = 2 + len(payload) + 1
         p = bytearray()
         p.append(address)
@@ -53,56 +334,58 @@ class DS2(K_Line):
         for x in payload:
             p.append(x)
         p.append(self._checksum(p))
-        print("TX : " + ''.join('{:02x} '.format(x) for x in p))
-        self._device.write(p)
+        return p
 
-    def _read(self):
-        p = bytearray()
-        try:
-            address = self._device.read(1)[0]
-        except IndexError:
+    def _write(self, address, payload):
+        p = self._frame(address, payload)
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("TX : " + ''.join('{:02x} '.format(x) for x in p))
+        self._send(p)
+
+    def _frame_length(self, buffer, start, available):
+        # address, size, ... , checksum - size counts the whole frame
+        if available < 2:
             return None
-        p.append(address)
-        size = self._device.read(1)[0]
-        #size = 0x1D
-        p.append(size)
-        remaining = ord(size) - 3
-        if remaining > 0:
-            payload = self._device.read(remaining)
-            for x in payload:
-                p.append(x)
-        expected_checksum = self._checksum(p)
-        actual_checksum = self._device.read(1)[0]
-        p.append(actual_checksum)
-        print("RX : " + ''.join('{:02x} '.format(x) for x in p))
-        print("RAW : " + ''.join('\\x{:02x}'.format(x) for x in p))
-        if ord(actual_checksum) != expected_checksum:
-            raise ProtocolError("invalid checksum")
-        return p
+        size = buffer[start + 1]
+        if size < 3:
+            raise ProtocolError("invalid length")
+        return size
 
-    def _execute(self, address, payload):
-        self._write(address, payload)
-        echo = self._read()
-        #self._device.timeout = 0.1
-        reply = self._read()
+    def _status(self, reply):
+        # a0 ok, a1 computer busy, anything else is refused
+        if reply is None or len(reply) < 3 or reply[2] == 0xa0:
+            return None
+        return 'busy' if reply[2] == 0xa1 else 'negative'
+
+    def _execute(self, address, payload, verbose=True):
+        self.pacer.wait(self.timing.p3_min)
+        reply = None
+        try:
+            self._write(address, payload)
+            reply = self._exchange(address, payload[0])
+        finally:
+            self.pacer.done(reply is not None)
+        return self._check(address, reply, verbose)
+
+    def _check(self, address, reply, verbose=True):
         if reply is None:
-            print("No response - Invalid Address ...")
+            _problem("No response - Invalid Address ...", verbose)
             return None
         sender = reply[0]
         length = reply[1]
         status = reply[2]
         if sender != address:
-            print("Unexpected address")
+            _problem("Unexpected address", verbose)
             return
         if status != 0xa0:
             if status == 0xa1:
-                print("Computer busy")
+                _problem("Computer busy", verbose)
             elif status == 0xa2:
-                print("Invalid parameter")
+                _problem("Invalid parameter", verbose)
             elif status == 0xff:
-                print("Invalid command")
+                _problem("Invalid command", verbose)
             else:
-                print("Unknown status")
+                _problem("Unknown status", verbose)
             return None
         return reply
 
@@ -111,11 +394,18 @@ class DS2(K_Line):
 #
 
 class KWP2000(K_Line):
-    def sniffer(self):
-        print("KWP2000 sniffer ...")
-        self._read()
+    TIMING = Timing()
+    ACCESS_TIMING_PARAMETERS = False
+    SESSION = 0x86
+    SESSION_BAUDRATE = None
+    ADDRESS = None
+    SOURCE = 0xf1
 
-    def _write(self, address, source, payload):
+    def query(self, payload):
+        """ Checked reply to payload without decoding it, nothing is printed """
+        return KWP2000._execute(self, self.ADDRESS, self.SOURCE, payload, verbose=False)
+
+    def _frame(self, address, source, payload):
         p = bytearray()
         p.append(0xb8)
         p.append(address)
@@ -124,139 +414,357 @@ class KWP2000(K_Line):
         for x in payload:
             p.append(x)
         p.append(self._checksum(p))
-        print("TX : " + ''.join('{:02x} '.format(x) for x in p))
+        return p
+
+    def _write(self, address, source, payload):
+        p = self._frame(address, source, payload)
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("TX : " + ''.join('{:02x} '.format(x) for x in p))
 
-        self._device.write(p)        
+        self._send(p)
         return 
 
-    def _read(self):
-        p = bytearray()
-        try:
-            header = self._device.read(1)[0]
-        except IndexError:
+    def _frame_length(self, buffer, start, available):
+        # 0xb8, target, source, size, ... , checksum - size counts the payload only
+        if available < 4:
             return None
-        p.append(header)
-        source = self._device.read(1)[0]
-        p.append(source)
-        address = self._device.read(1)[0]
-        p.append(address)
-        size = self._device.read(1)[0]
-        p.append(size)
-        remaining = ord(size)
-        if remaining > 0:
-            payload = self._device.read(remaining)
-            for x in payload:
-                p.append(x)
-        expected_checksum = self._checksum(p)
-        actual_checksum = self._device.read(1)[0]
-        p.append(actual_checksum)
-        print("RX : " + ''.join('{:02x} '.format(x) for x in p))
-        print("RAW : " + ''.join('\\x{:02x}'.format(x) for x in p))
-        if ord(actual_checksum) != expected_checksum:
-            raise ProtocolError("invalid checksum")
-        return p
+        return 4 + buffer[start + 3] + 1
 
-    def _execute(self, address, source, payload):
-        self._write(address, source, payload)
-        echo = self._read()
-        #self._device.timeout = 0.1
-        reply = self._read()
+    def _status(self, reply):
+        # 7f sid nrc - busyRepeatRequest (21) and responsePending (78) are busy
+        if reply is None or len(reply) < 7 or reply[4] != 0x7f:
+            return None
+        return 'busy' if reply[6] in (0x21, 0x78) else 'negative'
+
+    def _execute(self, address, source, payload, verbose=True):
+        self.pacer.wait(self.timing.p3_min)
+        reply = None
+        try:
+            self._write(address, source, payload)
+            reply = self._exchange(address, payload[0])
+        finally:
+            self.pacer.done(reply is not None)
+        return self._check(address, reply, verbose)
+
+    def _check(self, address, reply, verbose=True):
         if reply is None:
-            print("No response - Invalid Address ...")
+            _problem("No response - Invalid Address ...", verbose)
             return None
         header = reply[0]
         if header != 0xB8:
-            print("Unexpected header")
+            _problem("Unexpected header", verbose)
             return None
         return reply
+
+    def negotiate_timing(self, address, source=0xf1):
+        """ AccessTimingParameters (0x83) - switch to the fastest timing the ECU allows """
+        if not self.ACCESS_TIMING_PARAMETERS:
+            return None
+        # 83 00 - read limits, c3 00 p2min p2max p3min p3max p4min
+        reply = KWP2000._execute(self, address, source, bytes(b'\x83\x00'))
+        if reply is None or len(reply) < 12 or reply[4] != 0xc3:
+            print("Timing parameters not available")
+            return None
+        p2_min, p2_max, p3_min, p3_max, p4_min = reply[6:11]
+        p2_max = min(p2_max, int(self.timing.p2_max / 0.025), 0xf0)
+        p3_max = min(p3_max, int(self.timing.p3_max / 0.25))
+        # 83 03 - set parameters
+        reply = KWP2000._execute(self, address, source, bytes(bytearray([0x83, 0x03, p2_min, p2_max, p3_min, p3_max, p4_min])))
+        if reply is None or reply[4] != 0xc3:
+            print("Timing parameters rejected")
+            return None
+        self.timing.p2_min = p2_min * 0.0005
+        self.timing.p2_max = p2_max * 0.025
+        self.timing.p3_min = p3_min * 0.0005
+        self.timing.p3_max = p3_max * 0.25
+        self.timing.p4_min = p4_min * 0.0005
+        print("Timing : " + repr(self.timing))
+        return self.timing
+
+    def restore_timing(self, address, source=0xf1):
+        """ AccessTimingParameters (83 01) - back to the default timing on both sides """
+        KWP2000._execute(self, address, source, bytes(b'\x83\x01'))
+        self.timing = self.TIMING.copy()
+
+    def start_session(self, address, source=0xf1, baudrate=None):
+        """
+            StartDiagnosticSession (0x10) with a baudrate switch, falls back to 9600 if the ECU does not follow
+
+            Only switches when asked to, up to SESSION_BAUDRATE, and never on a
+            shared port - the other ECUs on the K-line stay at 9600
+        """
+        if baudrate is None or baudrate == self._device.baudrate:
+            return True
+        if self.SESSION_BAUDRATE is None or baudrate > self.SESSION_BAUDRATE:
+            print(str(baudrate) + " baud not supported")
+            return False
+        if self.shared():
+            print("Port shared with other ECUs, staying at " + str(self._device.baudrate) + " baud")
+            return False
+        reply = KWP2000._execute(self, address, source, bytes(bytearray([0x10, self.SESSION, BAUDRATE_IDS[baudrate]])))
+        if reply is None or reply[4] != 0x50:
+            print("Diagnostic session rejected")
+            return False
+        self._set_baudrate(baudrate)
+        # TesterPresent at the new rate
+        reply = KWP2000._execute(self, address, source, bytes(b'\x3e'))
+        if reply is None or reply[4] != 0x7e:
+            print("No response at " + str(baudrate) + " baud, falling back to " + str(DEFAULT_BAUDRATE))
+            self._set_baudrate(DEFAULT_BAUDRATE)
+            # Stay quiet until the ECU drops the session on P3max
+            time.sleep(self.timing.p3_max)
+            return False
+        print("Diagnostic session at " + str(baudrate) + " baud")
+        return True
+
+    def stop_session(self, address, source=0xf1):
+        if self._device.baudrate == DEFAULT_BAUDRATE:
+            return
+        # Back to the default session, the ECU returns to 9600 with it
+        KWP2000._execute(self, address, source, bytes(b'\x10\x81'))
+        self._set_baudrate(DEFAULT_BAUDRATE)
 #
 # MS41
 #
+# 0xa2 status block, no measurement table for it either, byte offsets count
+# from the DS2 address like ZF5HP24_TELEGRAMS, the first data byte after the
+# a0 status is byte 3
+#
+#   12 1d a0 02 bf 00 26 17 ab 4e 41 59 02 49 07 24 6a 88 22 7f 80 00 80 00 38 38 ce ce 09
+#   12 1d a0 03 20 00 24 10 a3 91 38 6a 01 b9 00 ce 4e 22 1e 88 8f 3a 6d ba 87 6c ce ce dd
+#
+
+MS41_TELEGRAMS = telegram.compile_table([
+    (b'\xa2', telegram.Channel('engine_speed', 3, 5, unit="1/min", label="engine speed")),
+    (b'\xa2', telegram.Channel('vehicle_speed', 5, 2, unit="km/h", label="vehicle speed")),
+    (b'\xa2', telegram.Channel('throttle_position', 6, 2, 0.47, unit="%", label="throttle position")),
+    (b'\xa2', telegram.Channel('engine_load', 7, 5, 0.021, unit="mg/stroke", label="engine load")),
+    (b'\xa2', telegram.Channel('air_temp', 9, 2, -0.458, 108, unit="C", label="air temp")),
+    (b'\xa2', telegram.Channel('coolant_temp', 10, 2, -0.458, 108, unit="C", label="coolant temp")),
+    (b'\xa2', telegram.Channel('ignition_time_advance', 11, 2, 0.373, -23.6, unit="BTDC",
+                                label="ignition time advance")),
+    (b'\xa2', telegram.Channel('injector_pulsewidth', 12, 5, 0.00534, unit="ms", label="injector pulse width")),
+    (b'\xa2', telegram.Channel('IACV', 14, 5, 0.00153, unit="%")),
+    # 16-17 unknown word
+    (b'\xa2', telegram.Channel('vanos_angle', 18, 2, 0.3745, unit="KW degrees", label="vanos angle")),
+    (b'\xa2', telegram.Channel('battery_voltage', 19, 2, 0.10196, unit="volts", label="battery voltage")),
+    # 20-23 lambda integrator 1 / 2
+    (b'\xa2', telegram.Channel('lambda_upstream_heater_1', 24, 2, 0.3906, unit="%",
+                                label="lambda upstream heater 1")),
+    (b'\xa2', telegram.Channel('lambda_upstream_heater_2', 25, 2, 0.3906, unit="%",
+                                label="lambda upstream heater 2")),
+    (b'\xa2', telegram.Channel('lambda_downstream_heater_1', 26, 2, 0.3906, unit="%",
+                                label="lambda downstream heater 1")),
+    (b'\xa2', telegram.Channel('lambda_downstream_heater_2', 27, 2, 0.3906, unit="%",
+                                label="lambda downstream heater 2")),
+])
 
 class MS41(DS2):
+    ADDRESS = DME
+    NAME = 'DME'
+
+    def __init__(self, bus=None, port=DEFAULT_PORT, parity=serial.PARITY_EVEN):
+        super(MS41, self).__init__(bus, port, parity)
+        self.telegrams = dict(MS41_TELEGRAMS)
+
     def run(self):
         for address in [ DME ]:
             print("Querying DME " + hex(address))
             data = self._execute(address, bytes(b'\x00'))
-            time.sleep(0.2)
-            #raw = b'\x12\x1D\xA0\x02\xBF\x00\x26\x17\xAB\x4E\x41\x59\x02\x49\x07\x24\x6A\x88\x22\x7F\x80\x00\x80\x00\x38\x38\xCE\xCE\x09'
-            #raw = b'\x12\x1D\xA0\x03\x20\x00\x24\x10\xA3\x91\x38\x6A\x01\xB9\x00\xCE\x4E\x22\x1E\x88\x8F\x3A\x6D\xBA\x87\x6C\xCE\xCE\xDD'
-            #data = struct.unpack('<' + 'B'*len(raw), raw)
+            data = self._execute(address, bytes(b'\xa2'))
 
     def _execute(self, address, payload):
         reply = super(MS41, self)._execute(address, payload)
         if reply is None:
             return
+        if self.changed_only and not self._changed(bytes(payload), reply):
+            return
 
-        p = reply[2:]
-        if payload == bytes(b'\xa2'):
-            engine_speed = struct.unpack('>H'*1, p[0:2])
-            print("engine speed : " + str(engine_speed[0]) + " 1/min")
-            vehicle_speed = struct.unpack('>B'*1, p[2])
-            print("vehicle speed : " + str(vehicle_speed[0]) + " km/h")
-            throttle_position = struct.unpack('>B'*1, p[3])
-            print("throttle position : " + str(throttle_position[0] * 0.47) + " %")
-            engine_load = struct.unpack('>H'*1, p[4:6])
-            print("engine load : " + str(engine_load[0] * 0.021) + " mg/stroke")
-            air_temp = struct.unpack('>B'*1, p[6])
-            print("air temp : " + str(air_temp[0] * (-0.458) + 108) + " C")
-            coolant_temp = struct.unpack('>B'*1, p[7])
-            print("coolant temp : " + str(coolant_temp[0] * (-0.458) + 108) + " C")
-            ignition_time_advance = struct.unpack('>B'*1, p[8])
-            print("ignition time advance : " + str(ignition_time_advance[0] * (0.373) + (-23.6)) + " BTDC")
-            injector_pulsewidth = struct.unpack('>H'*1, p[9:11])
-            print("injector pulse width : " + str(injector_pulsewidth[0] * 0.00534) + " ms")
-            IACV = struct.unpack('>H'*1, p[11:13])
-            print("IACV : " + str(IACV[0] * 0.00153) + " %")
-            # struct.unpack('>H'*1, p[13:15])
-            vanos_angle = struct.unpack('>B'*1, p[15])
-            print("vanos angle : " + str(vanos_angle[0] * 0.3745) + " KW degrees")
-            battery_voltage = struct.unpack('>B'*1, p[16])
-            print("battery voltage : " + str(battery_voltage[0] * 0.10196) + " volts")
-            # Lambda Integrator 1
-            # Lambda Integrator 2
-            lambda_upstream_heater_1 = struct.unpack('>B'*1, p[21])
-            print("lambda upstream heater 1 : " + str(lambda_upstream_heater_1[0] * 0.3906) + " %")
-            lambda_upstream_heater_2 = struct.unpack('>B'*1, p[22])
-            print("lambda upstream heater 2 : " + str(lambda_upstream_heater_2[0] * 0.3906) + " %")
-            lambda_downstream_heater_1 = struct.unpack('>B'*1, p[23])
-            print("lambda downstream heater 1 : " + str(lambda_downstream_heater_1[0] * 0.3906) + " %")
-            lambda_downstream_heater_2 = struct.unpack('>B'*1, p[24])
-            print("lambda downstream heater 2 : " + str(lambda_downstream_heater_2[0] * 0.3906) + " %")
-
+        if bytes(payload) in self.telegrams:
+            self._report(self.telegrams[bytes(payload)], reply)
         else:
-            print("Unknown payload")     
+            print("Unknown payload")
 
 #
 # Bosch Motronic v7.2 (M62TU) - KWP2000 protocol
+# Measurement tables ME72KWP1.xlsx (decoded from Ecu/ME72KWP1.PRG)
 #
 
+ME72_LABELS = {
+    'TI_W':         "injection time",
+    'VFZG':         "speed",
+    'NMOT_W':       "current rpm",
+    'NSOL':         "target rpm",
+    'TANS':         "intake air temp",
+    'TMOT':         "coolant temp",
+    'ZWOUT':        "ignation angle",
+    'WDKBA':        "engine throttle angle",
+    'MSHFM_W':      "engine air mass",
+    'MIIST_W':      "load",
+    'UB':           "battery voltage",
+    'UPWG_W':       "pedal position",
+    'TKA':          "coolant outlet temp",
+    'RKRN_W0':      "Knock sensor Cyl. 1",
+    'RKRN_W1':      "Knock sensor Cyl. 2",
+    'RKRN_W2':      "Knock sensor Cyl. 3",
+    'RKRN_W3':      "Knock sensor Cyl. 4",
+    'RKRN_W4':      "Knock sensor Cyl. 5",
+    'RKRN_W5':      "Knock sensor Cyl. 6",
+    'RKRN_W6':      "Knock sensor Cyl. 7",
+    'RKRN_W7':      "Knock sensor Cyl. 8",
+    'LUTSFI1':      "Roughness Cyl. 1",
+    'LUTSFI2':      "Roughness Cyl. 2",
+    'LUTSFI3':      "Roughness Cyl. 3",
+    'LUTSFI4':      "Roughness Cyl. 4",
+    'LUTSFI5':      "Roughness Cyl. 5",
+    'LUTSFI6':      "Roughness Cyl. 6",
+    'LUTSFI7':      "Roughness Cyl. 7",
+    'LUTSFI8':      "Roughness Cyl. 8",
+    'RKAT_W':       "Adaptation additive 1",
+    'RKAT2_W':      "Adaptation additive 2",
+    'FRA_W':        "Adaptation multiplicative 1",
+    'FRA2_W':       "Adaptation multiplicative 2",
+    'B_LDPEIN':     "leak diagnostic pump",
+    'B_SLP':        "secondary air pump",
+    'B_SLV':        "secondary air valve",
+    'B_HSVE':       "oxgen sensor heater before bank 1",
+    'B_HSVE2':      "oxgen sensor heater before bank 2",
+    'B_HSHE':       "oxgen sensor heater after bank 1",
+    'B_HSHE2':      "oxgen sensor heater after bank 2",
+    'B_AKR':        "exhaust gas recirculation",
+    'B_EBL':        "electric fan",
+    'B_EKP':        "fuel pump",
+    'B_ETR':        "thermostat",
+    'B_STA':        "start mode",
+    'B_LL':         "neutral switch",
+    'B_VL':         "acceleration enrichment",
+    'B_SBBHK2':     "oxygen sensor after bank 2 ready",
+    'B_SBBHK':      "oxygen sensor after bank 1 ready",
+    'B_SBBVK2':     "oxygen sensor before bank 2 ready",
+    'B_SBBVK':      "oxygen sensor before bank 1 ready",
+    'NWSSTAT':      "verification time VANOS 1",
+    'NWSSTAT2':     "verification time VANOS 2",
+    'TNWSFI':       "early time 1",
+    'TNWSFI2':      "early time 2",
+    'TNWSSI':       "delay time 1",
+    'TNWSSI2':      "delay time 2",
+    'NWSDSTAT':     "VANOS 1 tightness",
+    'NWSDSTAT2':    "VANOS 2 tightness",
+    'WNWI_W0':      "actual angle for VANOS 1",
+    'WNWI_W1':      "actual angle for VANOS 2",
+}
+
+ME72_TELEGRAMS = telegram.load_table(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'ME72KWP1.xlsx'), ME72_LABELS)
+
 class ME72(KWP2000):
-    def run(self):
-        for address in [ DME ]:
-            print("Querying DME " + hex(address))
-            source = bytes(b'\xf1')
-            self._execute(address, source, bytes(b'\xa2')) # b8 12 f1 01 a2 f8
-            time.sleep(0.2)
-            self._execute(address, source, bytes(b'\x22\x40\x00')) # b8 12 f1 03 22 40 00 3a
-            time.sleep(0.2)
-            self._execute(address, source, bytes(b'\x22\x40\x03'))
-            time.sleep(0.2)
-            self._execute(address, source, bytes(b'\x22\x40\x04'))
-            time.sleep(0.2)
-            self._execute(address, source, bytes(b'\x22\x40\x05'))
-            time.sleep(0.2)
-            self._execute(address, source, bytes(b'\x22\x40\x07')) # b8 12 f1 03 22 40 07 3d 
-            time.sleep(0.2)
-            self._execute(address, source, bytes(b'\x21\x13'))
-            time.sleep(0.2)
-            self._execute(address, source, bytes(b'\x21\x14'))
-            time.sleep(0.2)
+    ADDRESS = DME
+    NAME = 'DME'
+    ACCESS_TIMING_PARAMETERS = True
+    SESSION_BAUDRATE = 38400
+
+    def __init__(self, bus=None, port=DEFAULT_PORT, parity=serial.PARITY_EVEN):
+        super(ME72, self).__init__(bus, port, parity)
+        self.telegrams = dict(ME72_TELEGRAMS)
+
+    def define_identifier(self, names, identifier=0xf0, address=DME, source=0xf1):
+        """
+            DynamicallyDefineLocalIdentifier (0x2C) - pack just the bytes of the
+            given channels into one local identifier, read back with 21 <identifier>
+
+            2c f0 02 <position> <size> 40 00 <position in record> # from 22 40 00
+            2c f0 01 <position> <size> 13 <position in record>    # from 21 13
+        """
+        fields = []
+        channels = []
+        for name in names:
+            for request, table in ME72_TELEGRAMS.items():
+                channel = next((c for c in table.channels if c.name == name), None)
+                if channel is not None:
+                    break
+            else:
+                raise ValueError("unknown channel " + name)
+            if request[0] == 0x22:
+                field = (request, channel.byte - 6, channel.size) # 62 xx xx <data>
+            elif request[0] == 0x21:
+                field = (request, channel.byte - 5, channel.size) # 61 xx <data>
+            else:
+                raise ValueError(name + " is not read by local or common identifier")
+            # Bit channels share their byte, pack it once
+            if field not in fields:
+                fields.append(field)
+            channels.append((channel, fields.index(field)))
+
+        KWP2000._execute(self, address, source, bytes(bytearray([0x2c, identifier, 0x04]))) # clear
+        offsets = []
+        position = 1
+        for request, record_position, size in fields:
+            if request[0] == 0x22:
+                definition = [0x2c, identifier, 0x02, position, size, request[1], request[2], record_position]
+            else:
+                definition = [0x2c, identifier, 0x01, position, size, request[1], record_position]
+            reply = KWP2000._execute(self, address, source, bytes(bytearray(definition)))
+            if reply is None or reply[4] != 0x6c:
+                raise ProtocolError("local identifier definition rejected")
+            offsets.append(6 + position - 1) # 61 <identifier> <data>
+            position += size
+
+        request = bytes(bytearray([0x21, identifier]))
+        table = telegram.Telegram(request, [channel.relocate(offsets[i]) for channel, i in channels])
+        self.telegrams[request] = table
+        return table
+
+    def log(self, names, cycles=1, identifier=0xf0, baudrate=None):
+        """ Poll only the given channels, one request per cycle """
+        self.start_session(DME, baudrate=baudrate)
+        negotiated = None
+        try:
+            negotiated = self.negotiate_timing(DME)
+            table = self.define_identifier(names, identifier)
+            for cycle in range(cycles):
+                self._execute(DME, 0xf1, table.request)
+        finally:
+            if negotiated is not None:
+                self.restore_timing(DME)
+            self.stop_session(DME)
+        print("DME : " + self.pacer.summary())
+
+    def run(self, cycles=1, baudrate=None):
+        """ baudrate - switch to it for the session, SESSION_BAUDRATE at most """
+        self.start_session(DME, baudrate=baudrate)
+        negotiated = None
+        try:
+            negotiated = self.negotiate_timing(DME)
+            self._run(cycles)
+        finally:
+            if negotiated is not None:
+                self.restore_timing(DME)
+            self.stop_session(DME)
+        print("DME : " + self.pacer.summary())
+
+    def _run(self, cycles):
+        for cycle in range(cycles):
+            for address in [ DME ]:
+                print("Querying DME " + hex(address))
+                source = 0xf1
+                self._execute(address, source, bytes(b'\xa2')) # b8 12 f1 01 a2 f8
+                self._execute(address, source, bytes(b'\x22\x40\x00')) # b8 12 f1 03 22 40 00 3a
+                self._execute(address, source, bytes(b'\x22\x40\x03'))
+                self._execute(address, source, bytes(b'\x22\x40\x04'))
+                self._execute(address, source, bytes(b'\x22\x40\x05'))
+                self._execute(address, source, bytes(b'\x22\x40\x07')) # b8 12 f1 03 22 40 07 3d 
+                self._execute(address, source, bytes(b'\x21\x13'))
+                self._execute(address, source, bytes(b'\x21\x14'))
 
     def _execute(self, address, source, payload):
         reply = super(ME72, self)._execute(address, source, payload)
         if reply is None:
             return
+        if self.changed_only and not self._changed(bytes(payload), reply):
+            return
+        self.decode(payload, reply)
+
+    def decode(self, payload, reply):
+        """ Print the decoded reply to payload """
         """
         if payload == bytes(b'\x22\x40\x00'):
             reply = bytearray(b'\xb8\xf1\x12\x2d\x62\x40\x00\x00\xc3\x7e\x36\x81\xb4\x00\x0a\xec\x46\xff\xf1\x00\x21\x66\xc4\x11\x05\x00\xb5\x1b\x62\x8f\x00\x93\xaf\x00\x20\x00\x1f\x00\x1e\x00\x1f\x00\x25\x00\x1e\x00\x24\x00\x1e\x93')
@@ -271,7 +779,7 @@ class ME72(KWP2000):
         else:
             return
         """
-        p = reply[4:]
+        p = bytes(reply[4:])
         if payload == bytes(b'\xa2'):
             """
                 b8 12 f1 01 a2 f8
@@ -307,153 +815,8 @@ class ME72(KWP2000):
             supplier = p[20:26]
             print("supplier : " + supplier.decode('utf-8'))
         
-        elif payload == bytes(b'\x22\x40\x00'):
-            """
-                b8 12 f1 03 22 40 00 3a
-
-                b8 f1 12 2d                
-                62 40 00 
-                00 00 # injection time 
-                80 00 # Lambdaintegrator 1  
-                80 00 # Lambdaintegrator 2
-                00 # speed
-                00 00 # current rpm
-                50 # target rpm
-                00 00 # bsnk 1 camshift intake position  
-                00 00 # bsnk 2 camshift intake position
-                65 # intake air tempature
-                60 # coolant temperature 
-                00 # ignition angle 
-                05 # throttle angle 
-                00 00 # air mass
-                a8 d1 # Load 
-                7f # Battery voltage 
-                00 94 # pedal position
-                5e # coolant outlet temperature
-                0c 80 0c 80 0c 80 0c 80 0c 80 0c 80 0c 40 0c 80 # knock sensor of 8 cyl
-                08 # check sum
-            """
-            injection_time = struct.unpack('>H'*1, p[3:5])
-            print("injection time : " + str(injection_time[0] * 0.016) + " ms")
-            speed = p[9]
-            print("speed : " + str(speed * 1.25) + " km/h")
-            rpm = struct.unpack('>H'*1, p[10:12])
-            print("current rpm : " + str(rpm[0] * 0.25) + " RPM")
-            target_rpm = p[12]
-            print("target rpm : " + str(target_rpm * 10) + " RPM")
-            intake_air_temp = p[17]
-            print("intake air temp : " + str(intake_air_temp * 0.75 - 48.0) + " C")
-            coolant_temp = p[18]
-            print("coolant temp : " + str(coolant_temp * 0.75 - 48.0) + " C")
-            #ignation_angle = struct.unpack('>b'*1, str(p[19]))
-            ignation_angle = byte_to_int(p[19])
-            print("ignation angle : " + str(ignation_angle * 0.75) + " Grad")
-            engine_throttle_angle = p[20]
-            print("engine throttle angle : " + str(engine_throttle_angle * 0.39216) + " %")
-            engine_air_mass = struct.unpack('>H'*1, p[21:23])
-            print("engine air mass : " + str(engine_air_mass[0] * 0.1) + " kg/h")
-            load = struct.unpack('>H'*1, p[23:25])
-            print("load : " + str(load[0] * 0.0015259) + " %")
-            battery_voltage = p[25]
-            print("battery voltage : " + str(battery_voltage * 0.095) + " V")
-            pedal_position = struct.unpack('>H'*1, p[26:28])
-            print("pedal position : " + str(pedal_position[0] * 0.0048828) + " V")
-            coolant_outlet_temp = p[28]
-            print("coolant outlet temp : " + str(coolant_outlet_temp * 0.75 - 48.0) + " C")
-
-            r = struct.unpack('>H'*1, p[29:31])
-            print("Knock sensor Cyl. 1 : " + str(r[0] * 0.019531) + " V")
-            r = struct.unpack('>H'*1, p[31:33])
-            print("Knock sensor Cyl. 2 : " + str(r[0] * 0.019531) + " V")
-            r = struct.unpack('>H'*1, p[33:35])
-            print("Knock sensor Cyl. 3 : " + str(r[0] * 0.019531) + " V")
-            r = struct.unpack('>H'*1, p[35:37])
-            print("Knock sensor Cyl. 4 : " + str(r[0] * 0.019531) + " V")
-            r = struct.unpack('>H'*1, p[37:39])
-            print("Knock sensor Cyl. 5 : " + str(r[0] * 0.019531) + " V")
-            r = struct.unpack('>H'*1, p[39:41])
-            print("Knock sensor Cyl. 6 : " + str(r[0] * 0.019531) + " V")
-            r = struct.unpack('>H'*1, p[41:43])
-            print("Knock sensor Cyl. 7 : " + str(r[0] * 0.019531) + " V")
-            r = struct.unpack('>H'*1, p[43:45])
-            print("Knock sensor Cyl. 8 : " + str(r[0] * 0.019531) + " V")
-            
-        elif payload == bytes(b'\x22\x40\x03'):
-            r = struct.unpack('>h'*1, p[3:5])
-            print("Roughness Cyl. 1 : " + str(r[0] * 0.0027756) + " sec-1")
-            r = struct.unpack('>h'*1, p[5:7])
-            print("Roughness Cyl. 2 : " + str(r[0] * 0.0027756) + " sec-1")
-            r = struct.unpack('>h'*1, p[7:9])
-            print("Roughness Cyl. 3 : " + str(r[0] * 0.0027756) + " sec-1")
-            r = struct.unpack('>h'*1, p[9:11])
-            print("Roughness Cyl. 4 : " + str(r[0] * 0.0027756) + " sec-1")
-            r = struct.unpack('>h'*1, p[11:13])
-            print("Roughness Cyl. 5 : " + str(r[0] * 0.0027756) + " sec-1")
-            r = struct.unpack('>h'*1, p[13:15])
-            print("Roughness Cyl. 6 : " + str(r[0] * 0.0027756) + " sec-1")
-            r = struct.unpack('>h'*1, p[15:17])
-            print("Roughness Cyl. 7 : " + str(r[0] * 0.0027756) + " sec-1")
-            r = struct.unpack('>h'*1, p[17:19])
-            print("Roughness Cyl. 8 : " + str(r[0] * 0.0027756) + " sec-1")
-        
-        elif payload == bytes(b'\x22\x40\x04'):
-            r = struct.unpack('>h'*1, p[3:5])
-            print("Adaptation additive 1 : " + str(r[0] * 0.046875) + " %")
-            r = struct.unpack('>h'*1, p[5:7])
-            print("Adaptation additive 2 : " + str(r[0] * 0.046875) + " %")
-            r = struct.unpack('>h'*1, p[7:9])
-            print("Adaptation multiplicative 1 : " + str(r[0] * 0.0000305) + " %")
-            r = struct.unpack('>h'*1, p[9:11])
-            print("Adaptation multiplicative 2 : " + str(r[0] * 0.0000305) + " %")
-
-        elif payload == bytes(b'\x22\x40\x05'):
-            r = p[9]
-            print "leak diagnostic pump : %s" % ("On" if (r & 0x01) > 0 else "Off")
-            print "secondary air pump value : %s" % ("On" if (r & 0x02) > 0 else "Off")
-            print "oxgen sensor heater before bank 1 : %s" % ("On" if (r & 0x10) > 0 else "Off")
-            print "oxgen sensor heater before bank 2 : %s" % ("On" if (r & 0x20) > 0 else "Off")
-            print "oxgen sensor heater after bank 1 : %s" % ("On" if (r & 0x40) > 0 else "Off")
-            print "oxgen sensor heater after bank 2 : %s" % ("On" if (r & 0x80) > 0 else "Off")
-            r = p[10]
-            print "exhaust gas recirculation : %s" % ("On" if (r & 0x08) > 0 else "Off")
-            print "electric fan : %s" % ("On" if (r & 0x10) > 0 else "Off")
-            print "fuel pump : %s" % ("On" if (r & 0x20) > 0 else "Off")
-            print "thermostat : %s" % ("On" if (r & 0x40) > 0 else "Off")
-            print "start mode : %s" % ("On" if (r & 0x80) > 0 else "Off")
-
-        elif payload == bytes(b'\x22\x40\x07'):
-            """
-            b8 f1 12 05 62 40 07 01 90 ea
-            """
-            b = p[3]
-            print("neutral switch : " + str(b & (1 << 0)))
-            print("acceleration enrichment : " + str(b & (1 << 1)))
-            print "oxygen sensor after bank 2 ready : %s" % ("Yes" if(b & (1 << 2)) > 0 else "No")
-            print "oxygen sensor after bank 1 ready : %s" % ("Yes" if(b & (1 << 3)) > 0 else "No")
-            print "oxygen sensor before bank 2 ready : %s" % ("Yes" if(b & (1 << 4)) > 0 else "No")
-            print "oxygen sensor before bank 1 ready : %s" % ("Yes" if(b & (1 << 5)) > 0 else "No")
-        elif payload == bytes(b'\x21\x13'):
-            r = p[2]
-            print("verification time VANOS 1 : " + str(r))
-            r = p[3]
-            print("verification time VANOS 2 : " + str(r))
-            r = struct.unpack('>h'*1, p[4:6])
-            print("early time 1 : " + str(r[0] * 0.01) + " secs")
-            r = struct.unpack('>h'*1, p[6:8])
-            print("early time 2 : " + str(r[0] * 0.01) + " secs")
-            r = struct.unpack('>h'*1, p[8:10])
-            print("delay time 1 : " + str(r[0] * 0.01) + " secs")
-            r = struct.unpack('>h'*1, p[10:12])
-            print("delay time 2 : " + str(r[0] * 0.01) + " secs")
-        elif payload == bytes(b'\x21\x14'):
-            r = p[2]
-            print("VANOS 1 tightness : " + str(r))
-            r = p[3]
-            print("VANOS 2 tightness : " + str(r))
-            r = struct.unpack('>h'*1, p[4:6])
-            print("actual angle for VANOS 1 : " + str(r[0] * 0.0039) + " GrandKW")
-            r = struct.unpack('>h'*1, p[6:8])
-            print("actual angle for VANOS 2 : " + str(r[0] * 0.0039) + " GrandKW")
+        elif bytes(payload) in self.telegrams:
+            self._report(self.telegrams[bytes(payload)], reply)
         else:
             print("Unknown payload")
 
@@ -529,21 +892,54 @@ error_flags = {
     0xFF:       "Unknown"
 }
 
+#
+# 0x0B 03 status block, Ecu/GS8602.PRG has no measurement table for it so
+# the layout is kept here in the same shape as ME72KWP1.xlsx
+#
+
+ZF5HP24_TELEGRAMS = telegram.compile_table([
+    (b'\x0B\x03', telegram.Channel('rpm', 3, 2, 32, unit="RPM")),
+    (b'\x0B\x03', telegram.Channel('input_turbine_rpm', 4, 2, 32, unit="RPM", label="input turbine rpm")),
+    (b'\x0B\x03', telegram.Channel('output_shift_rpm', 5, 2, 32, unit="RPM", label="output shift rpm")),
+    (b'\x0B\x03', telegram.Channel('coolant_temp', 8, 2, 1, -48, unit="C", label="coolant temperature")),
+    (b'\x0B\x03', telegram.Channel('transmission_temp', 9, 2, 1, -54, unit="C", label="transmission temperature")),
+    (b'\x0B\x03', telegram.Channel('cruise_control', 22, 2, mask=0xE0, label="cruise control mode",
+                                    text={0: "off", 1: "on", 2: "resume", 3: "accel", 4: "decel"})),
+    (b'\x0B\x03', telegram.Channel('gear', 23, 2, mask=0xE0, text={6: "1", 7: "reverse"})),
+    (b'\x0B\x03', telegram.Channel('shifter', 23, 2, mask=0x03, label="shifter steptronic",
+                                    text={0: "neutral", 1: "up", 2: "down", 3: "neutral"})),
+    (b'\x0B\x03', telegram.Channel('kickdown', 23, 1, mask=0x10, value=0x10, text={0: "No", 1: "yes"})),
+    (b'\x0B\x03', telegram.Channel('vehicle_in_curve', 23, 1, mask=0x08, value=0x08, label="vehicle in curve",
+                                    text={0: "No", 1: "yes"})),
+])
+
 class ZF5HP24(DS2):
-    def run(self):
-        for address in [ EGS ]:
-            print("Querying EGS " + hex(address))
-            data = self._execute(address, bytes(b'\x00'))
-            time.sleep(0.2)
-            data = self._execute(address, bytes(b'\x0B\x03'))
-            time.sleep(0.2)
-            data = self._execute(address, bytes(b'\x04\x01'))
-            time.sleep(0.2)
+    ADDRESS = EGS
+    NAME = 'EGS'
+
+    def __init__(self, bus=None, port=DEFAULT_PORT, parity=serial.PARITY_EVEN):
+        super(ZF5HP24, self).__init__(bus, port, parity)
+        self.telegrams = dict(ZF5HP24_TELEGRAMS)
+
+    def run(self, cycles=1):
+        for cycle in range(cycles):
+            for address in [ EGS ]:
+                print("Querying EGS " + hex(address))
+                data = self._execute(address, bytes(b'\x00'))
+                data = self._execute(address, bytes(b'\x0B\x03'))
+                data = self._execute(address, bytes(b'\x04\x01'))
+        print("EGS : " + self.pacer.summary())
 
     def _execute(self, address, payload):
         reply = super(ZF5HP24, self)._execute(address, payload)
         if reply is None:
             return
+        if self.changed_only and not self._changed(bytes(payload), reply):
+            return
+        self.decode(payload, reply)
+
+    def decode(self, payload, reply):
+        """ Print the decoded reply to payload """
         """
         if payload == bytes(b'\x00'):
             reply = bytearray(b'\x32\x2e\xa0\x31\x34\x32\x33\x39\x35\x33\x32\x42\x30\x30\x31\x31\x36\x30\x34\x38\x39\x39\x30\x30\x30\x30\x30\x30\x30\x30\x30\x30\x30\x39\x31\x30\x46\x4f\x34\x38\x39\x30\x32\x36\x36\xcb')
@@ -554,7 +950,7 @@ class ZF5HP24(DS2):
         else:
             return
         """
-        p = reply[2:]
+        p = bytes(reply[2:])
         if payload == bytes(b'\x00'):
             """
                 32 04 00 36 
@@ -617,50 +1013,7 @@ class ZF5HP24(DS2):
                 59 b5
 
             """
-            rpm = p[1] # struct.unpack('>B'*1, p[1])
-            print("rpm : " + str(rpm * 32) + " RPM")
-            input_turbine_rpm = p[2]
-            print("input turbine rpm : " + str(input_turbine_rpm * 32) + " RPM")
-            output_shift_rpm = p[3]
-            print("output shift rpm : " + str(output_shift_rpm * 32) + " RPM")
-            coolant_temp = p[6]
-            print("coolant temperature : " + str(coolant_temp - 48) + " C")
-            transmission_temp = p[7]
-            print("transmission temperature : " + str(transmission_temp - 54) + " C")
-            cruise_control = p[20]
-            if cruise_control == 0x0:
-                print("cruise control mode : off")
-            elif cruise_control == 0x20:
-                print("cruise control mode : on")
-            elif cruise_control == 0x40:
-                print("cruise control mode : resume")
-            elif cruise_control == 0x60:
-                print("cruise control mode : accel")
-            elif cruise_control == 0x80:
-                print("cruise control mode : decel")
-            else:
-                print("cruise control mode : unknown")
-
-            gear = p[21]            
-            g = gear >> 5
-            if g == 0x6:
-                print("gear : 1")
-            elif g == 0x7:
-                print("gear : reverse")
-            else:
-                print("gear : " + str(gear >> 5))
-
-            shifter = gear & 0x3
-            if shifter == 0x1:
-                print("shifter steptronic : up")
-            elif shifter == 0x2:
-                print("shifter steptronic : down")
-            else:
-                print("shifter steptronic : neutral")
-            kickdown = gear & 0x10
-            print "kickdown : %s" % ("yes" if kickdown > 0 else "No")
-            vehicle_in_curve = gear & 0x8
-            print "vehicle in curve : %s" % ("yes" if vehicle_in_curve > 0 else "No")
+            self._report(self.telegrams[bytes(payload)], reply)
 
         elif payload == bytes(b'\x04\x01'):
             error_code_count = p[1]
@@ -670,42 +1023,96 @@ class ZF5HP24(DS2):
                 did = p[2]
                 fid = p[3]
                 freq = p[4]
-                print("(" + str(freg) + ") " + "error code 0 : " + error_code.decode('utf-8') + " : " + error_description[did] + " : " + error_flags[fid])
+                print("(" + str(freq) + ") " + "error code 0 : " + error_code.hex() + " : " + error_description.get(did, "Unknown") + " : " + error_flags.get(fid, "Unknown"))
             if len(p) >= 24:
                 error_code = p[21:23]
                 did = p[21]
                 fid = p[22]
                 freq = p[23]
-                print("(" + str(freg) + ") " + "error code 1 : " + error_code.decode('utf-8') + " : " + error_description[did] + " : " + error_flags[fid])
+                print("(" + str(freq) + ") " + "error code 1 : " + error_code.hex() + " : " + error_description.get(did, "Unknown") + " : " + error_flags.get(fid, "Unknown"))
             if len(p) >= 43:
                 error_code = p[40:42]
                 did = p[40]
                 fid = p[41]
                 freq = p[42]
-                print("(" + str(freg) + ") " + "error code 2 : " + error_code.decode('utf-8') + " : " + error_description[did] + " : " + error_flags[fid])
+                print("(" + str(freq) + ") " + "error code 2 : " + error_code.hex() + " : " + error_description.get(did, "Unknown") + " : " + error_flags.get(fid, "Unknown"))
             if len(p) >= 62:
                 error_code = p[59:61]
                 did = p[59]
                 fid = p[60]
                 freq = p[61]
-                print("(" + str(freg) + ") " + "error code 3 : " + error_code.decode('utf-8') + " : " + error_description[did] + " : " + error_flags[fid])
+                print("(" + str(freq) + ") " + "error code 3 : " + error_code.hex() + " : " + error_description.get(did, "Unknown") + " : " + error_flags.get(fid, "Unknown"))
             if len(p) >= 81:
                 error_code = p[78:80]
                 did = p[78]
                 fid = p[79]
                 freq = p[80]
-                print("(" + str(freg) + ") " + "error code 4 : " + error_code.decode('utf-8') + " : " + error_description[did] + " : " + error_flags[fid])
+                print("(" + str(freq) + ") " + "error code 4 : " + error_code.hex() + " : " + error_description.get(did, "Unknown") + " : " + error_flags.get(fid, "Unknown"))
          
         else:
             print("Unknown payload")
 
-egs = ZF5HP24()
-egs.run()
+#
+# Signal names across DME and EGS for the query planner (planner.py),
+# sources in order of preference
+#
+
+SIGNALS = {
+    'engine_rpm':           [('DME', 'NMOT_W')],
+    'target_rpm':           [('DME', 'NSOL')],
+    'vehicle_speed':        [('DME', 'VFZG')],
+    'injection_time':       [('DME', 'TI_W')],
+    'intake_air_temp':      [('DME', 'TANS')],
+    'coolant_temp':         [('DME', 'TMOT'), ('EGS', 'coolant_temp')],
+    'coolant_outlet_temp':  [('DME', 'TKA')],
+    'ignition_angle':       [('DME', 'ZWOUT')],
+    'throttle_angle':       [('DME', 'WDKBA')],
+    'air_mass':             [('DME', 'MSHFM_W')],
+    'engine_load':          [('DME', 'MIIST_W')],
+    'battery_voltage':      [('DME', 'UB')],
+    'pedal_position':       [('DME', 'UPWG_W')],
+    'vanos_angle_1':        [('DME', 'WNWI_W0')],
+    'vanos_angle_2':        [('DME', 'WNWI_W1')],
+    'transmission_temp':    [('EGS', 'transmission_temp')],
+    'turbine_rpm':          [('EGS', 'input_turbine_rpm')],
+    'output_rpm':           [('EGS', 'output_shift_rpm')],
+    'gear':                 [('EGS', 'gear')],
+    'shifter':              [('EGS', 'shifter')],
+    'kickdown':             [('EGS', 'kickdown')],
+    'cruise_control':       [('EGS', 'cruise_control')],
+    'vehicle_in_curve':     [('EGS', 'vehicle_in_curve')],
+}
+for cylinder in range(1, 9):
+    SIGNALS['knock_cyl' + str(cylinder)] = [('DME', 'RKRN_W' + str(cylinder - 1))]
+    SIGNALS['roughness_cyl' + str(cylinder)] = [('DME', 'LUTSFI' + str(cylinder))]
+
+TABLES = {
+    'DME':  ME72_TELEGRAMS,
+    'EGS':  ZF5HP24_TELEGRAMS
+}
+
+if __name__ == '__main__':
+    import signal
+
+    # The scan tool shows every frame
+    logging.basicConfig(level=logging.DEBUG, format='%(message)s')
+
+    ecus = []
+    # kill -USR1 <pid> prints the bus statistics so far
+    signal.signal(signal.SIGUSR1, lambda signum, frame: [print(ecu.stats.dump()) for ecu in ecus])
+
+    egs = ZF5HP24()
+    ecus.append(egs)
+    egs.run()
+
+    dme = ME72()
+    ecus.append(dme)
+    dme.run()
 
-dme = ME72()
-dme.run()
-"""
-ds2 = DS2()
-while 1:
-    ds2.sniffer()
-"""
\ No newline at end of file
+    for ecu in ecus:
+        print(ecu.stats.dump())
+    """
+    ds2 = DS2()
+    while 1:
+        ds2.sniffer()
+    """
\ No newline at end of file
@@ -0,0 +1,281 @@
+#-*-coding:utf-8 -*-
+#
+# ECU emulator on a pseudo terminal - ME7.2 (KWP2000) and GS8.60.2 (DS2)
+# answering like they do on the K-line, no car needed.
+#
+#   emu = Emulator(latency=0.02, checksum_errors=0.01)
+#   emu.start()
+#   dme = ME72(port=emu.port, parity=serial.PARITY_NONE)
+#
+#   python emulator.py --baudrate 9600 --latency 0.02
+#
+# Every byte written to the pty is echoed back like on the K-line. Replies
+# follow after `latency` seconds and are paced at the emulated baud rate
+# (11 bit times per byte, 8E1). Linux ptys refuse parity, so the client
+# opens the port with PARITY_NONE.
+#
+# Replies come from replayed traffic (replay() of a ds2.py console log),
+# then from the canned frames below, then zero filled blocks for every
+# other telegram of ME72KWP1.xlsx.
+#
+
+import os
+import random
+import threading
+import time
+import tty
+
+import ds2
+from ds2 import DME, EGS, DEFAULT_BAUDRATE, BAUDRATE_IDS
+
+# Recorded on an E39 540i, the same frames as the comments in ds2.py
+DME_REPLIES = {
+    b'\xa2': '''b8 f1 12 2b e2 37 35 30 36 33 36 36 30 46 30 31 41 38 36 30 30 38 30 30 30 30 31 30 32 31
+                33 35 31 30 ff ff ff ff 30 30 30 30 38 33 38 32 38 99''',
+    b'\x22\x40\x00': '''b8 f1 12 2d 62 40 00 00 c3 7e 36 81 b4 00 0a ec 46 ff f1 00 21 66 c4 11 05 00 b5 1b 62 8f
+                        00 93 af 00 20 00 1f 00 1e 00 1f 00 25 00 1e 00 24 00 1e 93''',
+    b'\x22\x40\x03': '''b8 f1 12 18 62 40 03 ff 70 ff 4e 00 00 ff d8 00 32 00 90 00 0c 00 8e 01 00 e5 01 26 98''',
+    b'\x22\x40\x04': '''b8 f1 12 13 62 40 04 00 2c 00 20 82 83 80 0c 6c 6c 6c 6c 00 f5 01 15 0e''',
+    b'\x22\x40\x05': '''b8 f1 12 0b 62 40 05 2b 00 00 f2 f2 ce f8 20 4a''',
+    b'\x22\x40\x07': '''b8 f1 12 05 62 40 07 fd 10 96''',
+}
+
+EGS_REPLIES = {
+    b'\x00': '''32 2e a0 31 34 32 33 39 35 33 32 42 30 30 31 31 36 30 34 38 39 39 30 30 30 30 30 30 30 30
+                30 30 30 39 31 30 46 4f 34 38 39 30 32 36 36 cb''',
+    b'\x0B\x03': '''32 1c a0 15 15 00 00 01 93 7f a8 01 01 01 01 0f 00 00 ff 00 a2 dc 01 c0 40 00 59 9d''',
+    b'\x04\x01': '''32 06 a0 00 00 94''',
+}
+
+def _checksum(message):
+    result = 0
+    for b in message:
+        result ^= b
+    return result
+
+class ME72Model(object):
+    """ KWP2000 side of the DME, payload in -> payload out """
+    ADDRESS = DME
+    PROTOCOL = 'KWP2000'
+
+    def __init__(self):
+        self.replies = dict((request, bytes.fromhex(frame)[4:-1]) for request, frame in DME_REPLIES.items())
+        for request, table in ds2.ME72_TELEGRAMS.items():
+            if request not in self.replies:
+                # Positive response, zero data up to the end of the table
+                reply = bytearray([request[0] + 0x40]) + request[1:]
+                self.replies[request] = bytes(reply + bytearray(max(len(table) - 4 - len(reply), 0)))
+        self.identifiers = {}
+        self.baudrate = None
+
+    def answer(self, payload):
+        sid = payload[0]
+        if payload in self.replies:
+            return self.replies[payload]
+        if sid == 0x83 and payload[1:2] == b'\x00':
+            # p2min 0 ms, p2max 50 ms, p3min 5 ms, p3max 5 s, p4min 0 ms
+            return bytes(bytearray([0xc3, 0x00, 0x00, 0x02, 0x0a, 0x14, 0x00]))
+        if sid == 0x83 and payload[1:2] in (b'\x01', b'\x03'):
+            return bytes(bytearray([0xc3])) + payload[1:2]
+        if sid == 0x10:
+            if payload[1] == 0x81:
+                self.baudrate = DEFAULT_BAUDRATE
+            elif len(payload) > 2:
+                self.baudrate = dict((v, k) for k, v in BAUDRATE_IDS.items()).get(payload[2])
+            return bytes(bytearray([0x50])) + payload[1:]
+        if sid == 0x3e:
+            return bytes(bytearray([0x7e]))
+        if sid == 0x2c:
+            return self._define(payload)
+        if sid == 0x21 and payload[1] in self.identifiers:
+            return self._identifier(payload[1])
+        return bytes(bytearray([0x7f, sid, 0x11])) # serviceNotSupported
+
+    def _define(self, payload):
+        identifier, mode = payload[1], payload[2]
+        if mode == 0x04:
+            self.identifiers[identifier] = []
+        elif mode == 0x02:
+            # position, size, common identifier, position in record
+            self.identifiers.setdefault(identifier, []).append(
+                (payload[3], payload[4], bytes(bytearray([0x22])) + payload[5:7], 3 + payload[7] - 1))
+        elif mode == 0x01:
+            self.identifiers.setdefault(identifier, []).append(
+                (payload[3], payload[4], bytes(bytearray([0x21])) + payload[5:6], 2 + payload[6] - 1))
+        else:
+            return bytes(bytearray([0x7f, 0x2c, 0x12])) # subFunctionNotSupported
+        return bytes(bytearray([0x6c, identifier]))
+
+    def _identifier(self, identifier):
+        data = bytearray([0x61, identifier])
+        for position, size, request, start in sorted(self.identifiers[identifier]):
+            record = self.replies.get(request, b'')
+            data += record[start:start + size].ljust(size, b'\x00')
+        return bytes(data)
+
+class ZF5HP24Model(object):
+    """ DS2 side of the EGS, payload in -> status + data out """
+    ADDRESS = EGS
+    PROTOCOL = 'DS2'
+
+    def __init__(self):
+        self.replies = dict((request, bytes.fromhex(frame)[2:-1]) for request, frame in EGS_REPLIES.items())
+        self.baudrate = None
+
+    def answer(self, payload):
+        if payload in self.replies:
+            return self.replies[payload]
+        return bytes(bytearray([0xff])) # invalid command
+
+def respond(models, frame):
+    """ Reply frame of the addressed model, None if nobody answers (or not in that protocol) """
+    frame = bytes(frame)
+    if frame[0] == 0xb8:
+        model = models.get(frame[1])
+        if model is None or model.PROTOCOL != 'KWP2000':
+            return None
+        payload = model.answer(frame[4:-1])
+        reply = bytearray([0xb8, frame[2], frame[1], len(payload)]) + payload
+    else:
+        model = models.get(frame[0])
+        if model is None or model.PROTOCOL != 'DS2':
+            return None
+        payload = model.answer(frame[2:-1])
+        reply = bytearray([frame[0], 2 + len(payload) + 1]) + payload
+    reply.append(_checksum(reply))
+    return reply
+
+class Emulator(object):
+    def __init__(self, models=None, baudrate=DEFAULT_BAUDRATE, latency=0.02,
+                 checksum_errors=0.0, timeouts=0.0, seed=None):
+        if models is None:
+            models = [ME72Model(), ZF5HP24Model()]
+        self.models = dict((model.ADDRESS, model) for model in models)
+        self.baudrate = baudrate
+        self.latency = latency
+        self.checksum_errors = checksum_errors
+        self.timeouts = timeouts
+        self.replayed = {}
+        self.requests = 0
+        self.injected = 0
+        self._random = random.Random(seed)
+        self._master, self._slave = os.openpty()
+        tty.setraw(self._slave)
+        self.port = os.ttyname(self._slave)
+        self._thread = None
+        self._running = False
+
+    def replay(self, path):
+        """ Serve the replies of a ds2.py console log (TX / RX echo / RX reply lines), in order and round robin """
+        last = None
+        rx = 0
+        for line in open(path):
+            if line.startswith("TX : "):
+                last = bytes.fromhex(line[5:])
+                rx = 0
+            elif line.startswith("RX : ") and last is not None:
+                rx += 1
+                if rx == 2: # the first RX is the echo
+                    self.replayed.setdefault(last, []).append(bytes.fromhex(line[5:]))
+        return len(self.replayed)
+
+    def start(self):
+        self._running = True
+        self._thread = threading.Thread(target=self._serve, name="emulator")
+        self._thread.daemon = True
+        self._thread.start()
+        return self.port
+
+    def close(self):
+        self._running = False
+        os.close(self._slave)
+        os.close(self._master)
+
+    def _serve(self):
+        buffer = bytearray()
+        while self._running:
+            try:
+                data = os.read(self._master, 1024)
+            except OSError:
+                return
+            if not data:
+                return
+            os.write(self._master, data) # K-line echo
+            buffer += data
+            while True:
+                size = self._frame_length(buffer)
+                if size is None or size > len(buffer):
+                    break
+                frame = bytes(buffer[:size])
+                del buffer[:size]
+                if frame[-1] != _checksum(frame[:-1]):
+                    continue # ECUs ignore broken requests
+                reply = self._answer(frame)
+                if reply is not None:
+                    self._send(reply)
+
+    def _frame_length(self, buffer):
+        if buffer and buffer[0] == 0xb8:
+            return 4 + buffer[3] + 1 if len(buffer) >= 4 else None
+        if len(buffer) >= 2:
+            # Garbage length, drop the byte and resync
+            if buffer[1] < 3:
+                del buffer[:1]
+                return self._frame_length(buffer)
+            return buffer[1]
+        return None
+
+    def _answer(self, frame):
+        self.requests += 1
+        if self.timeouts and self._random.random() < self.timeouts:
+            self.injected += 1
+            return None
+        if frame in self.replayed:
+            replies = self.replayed[frame]
+            reply = bytearray(replies[0])
+            replies.append(replies.pop(0))
+        else:
+            reply = respond(self.models, frame)
+            if reply is None:
+                return None
+        if self.checksum_errors and self._random.random() < self.checksum_errors:
+            self.injected += 1
+            reply[-1] ^= 0xff
+        return reply
+
+    def _send(self, reply):
+        time.sleep(self.latency)
+        # Pace the bytes at the emulated rate, a few at a time - the pty
+        # would hand the whole reply over at once
+        baudrate = self.baudrate
+        for model in self.models.values():
+            baudrate = model.baudrate or baudrate
+        reply = bytes(reply)
+        for i in range(0, len(reply), 8):
+            chunk = reply[i:i + 8]
+            time.sleep(len(chunk) * 11.0 / baudrate)
+            os.write(self._master, chunk)
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description="ME7.2 / GS8.60.2 emulator on a pseudo terminal")
+    parser.add_argument('--baudrate', type=int, default=DEFAULT_BAUDRATE)
+    parser.add_argument('--latency', type=float, default=0.02, help="seconds between request and reply")
+    parser.add_argument('--checksum-errors', type=float, default=0.0, help="share of replies with a bad checksum")
+    parser.add_argument('--timeouts', type=float, default=0.0, help="share of requests left unanswered")
+    parser.add_argument('--replay', help="ds2.py console log to replay")
+    args = parser.parse_args()
+
+    emu = Emulator(baudrate=args.baudrate, latency=args.latency,
+                   checksum_errors=args.checksum_errors, timeouts=args.timeouts)
+    if args.replay:
+        print(str(emu.replay(args.replay)) + " replayed requests")
+    emu.start()
+    print("ECU emulator on " + emu.port)
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        pass
+    print(str(emu.requests) + " requests, " + str(emu.injected) + " faults injected")
@@ -0,0 +1,147 @@
+#-*-coding:utf-8 -*-
+#
+# Streaming column export - decoded replies are buffered into column
+# batches and written to CSV, Parquet or Arrow files in large chunks, one
+# file and one fixed schema per ECU.
+#
+#   dme = ME72()
+#   with Exporter('dme.parquet', dme.telegrams) as out:
+#       Pipeline([(dme, b'\x22\x40\x00')], consumer=out.record).run(duration=600)
+#
+# The schema is 't' (wall clock seconds) plus every channel of the ECU's
+# telegrams. A row carries the channels of the telegram it was decoded
+# from, the other columns stay empty. Parquet and Arrow need pyarrow.
+#
+
+import csv
+
+try:
+    import pyarrow
+    import pyarrow.ipc
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+FORMATS = ('csv', 'parquet', 'arrow')
+
+class Column(object):
+    __slots__ = ('name', 'unit', 'integer')
+
+    def __init__(self, name, unit='', integer=False):
+        self.name = name
+        self.unit = unit
+        self.integer = integer
+
+def schema(telegrams):
+    """ Fixed column list for { request : Telegram } """
+    columns = [Column('t', 's')]
+    seen = set(['t'])
+    for request, table in telegrams.items():
+        for c in table.channels:
+            if c.name in seen:
+                continue
+            seen.add(c.name)
+            # Bit channels and integer scaling stay integers
+            integer = c.data_type == 1 or (isinstance(c.fact_a, int) and isinstance(c.fact_b, int))
+            columns.append(Column(c.name, c.unit, integer))
+    return columns
+
+class Exporter(object):
+    def __init__(self, path, telegrams, format=None, batch=4096):
+        if format is None:
+            format = path.rsplit('.', 1)[-1].lower()
+            format = 'arrow' if format in ('arrow', 'feather', 'ipc') else format
+        if format not in FORMATS:
+            raise ValueError("unknown format " + format)
+        if format != 'csv' and pyarrow is None:
+            raise ImportError(format + " export needs pyarrow")
+        self.path = path
+        self.format = format
+        self.telegrams = telegrams
+        self.batch = batch
+        self.columns = schema(telegrams)
+        self.rows = 0
+        self._index = dict((c.name, i) for i, c in enumerate(self.columns))
+        # Per telegram, the column of every channel in decode order
+        self._positions = dict((request, [self._index[c.name] for c in table.channels])
+                               for request, table in telegrams.items())
+        self._buffer = [[] for c in self.columns]
+        self._pending = 0
+        self._writer = None
+        self._file = None
+
+    def add(self, timestamp, request, values):
+        """ values in the channel order of telegrams[request] """
+        row = [None] * len(self.columns)
+        row[0] = timestamp
+        for position, value in zip(self._positions[request], values):
+            row[position] = value
+        for column, value in zip(self._buffer, row):
+            column.append(value)
+        self._pending += 1
+        if self._pending >= self.batch:
+            self.flush()
+
+    def record(self, frame):
+        """ pipeline.Pipeline consumer """
+        request = bytes(frame.request)
+        table = self.telegrams.get(request)
+        if table is None or frame.reply is None:
+            return
+        self.add(frame.timestamp, request, table.decode(frame.reply))
+
+    def flush(self):
+        if not self._pending:
+            return
+        if self.format == 'csv':
+            self._write_csv()
+        else:
+            self._write_arrow()
+        self.rows += self._pending
+        self._buffer = [[] for c in self.columns]
+        self._pending = 0
+
+    def _write_csv(self):
+        if self._writer is None:
+            self._file = open(self.path, 'w', newline='')
+            self._writer = csv.writer(self._file)
+            self._writer.writerow([c.name for c in self.columns])
+            self._writer.writerow([c.unit for c in self.columns])
+        self._writer.writerows(zip(*self._buffer))
+
+    def _arrow_schema(self):
+        fields = []
+        for c in self.columns:
+            kind = pyarrow.int64() if c.integer else pyarrow.float64()
+            fields.append(pyarrow.field(c.name, kind, metadata={'unit': c.unit}))
+        return pyarrow.schema(fields)
+
+    def _write_arrow(self):
+        if self._writer is None:
+            self._schema = self._arrow_schema()
+            if self.format == 'parquet':
+                self._writer = pyarrow.parquet.ParquetWriter(self.path, self._schema)
+            else:
+                self._file = pyarrow.OSFile(self.path, 'wb')
+                self._writer = pyarrow.ipc.new_file(self._file, self._schema)
+        arrays = [pyarrow.array(column, type=field.type) for column, field in zip(self._buffer, self._schema)]
+        batch = pyarrow.RecordBatch.from_arrays(arrays, schema=self._schema)
+        if self.format == 'parquet':
+            self._writer.write_table(pyarrow.Table.from_batches([batch]))
+        else:
+            self._writer.write_batch(batch)
+
+    def close(self):
+        self.flush()
+        if self._writer is not None and self.format != 'csv':
+            self._writer.close()
+        if self._file is not None:
+            self._file.close()
+        self._writer = None
+        self._file = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
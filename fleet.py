@@ -0,0 +1,164 @@
+#-*-coding:utf-8 -*-
+#
+# Fleet mode - one worker process per K+DCAN cable, each polling its car's
+# DME and EGS, the parent collects every sample into one stream.
+#
+#   python fleet.py                      # every USB serial adapter found
+#   python fleet.py /dev/ttyUSB0 /dev/ttyUSB1 --duration 600
+#
+# Workers decode in their own process and send batches of
+# (ecu, request, timestamp, values) back over a multiprocessing queue, so
+# throughput grows with the number of cables rather than sharing one GIL.
+# A worker that dies (cable pulled, port error) is started again after
+# `restart_delay` seconds.
+#
+
+import multiprocessing
+import queue
+import time
+
+import serial
+
+import ds2
+
+# (ecu, request) polled by every worker, DME and EGS share the K-line
+JOBS = [
+    ('DME', b'\x22\x40\x00'),
+    ('DME', b'\x22\x40\x03'),
+    ('EGS', b'\x0B\x03'),
+]
+
+def adapters():
+    """ Serial ports that look like USB adapters """
+    from serial.tools import list_ports
+    return sorted(port.device for port in list_ports.comports() if port.vid is not None)
+
+def _worker(port, parity, jobs, output, stop, batch):
+    dme = ds2.ME72(port=port, parity=parity)
+    ecus = { 'DME' : dme, 'EGS' : ds2.ZF5HP24(bus=dme) }
+    pending = []
+    sent = time.monotonic()
+    while not stop.is_set():
+        for name, request in jobs:
+            ecu = ecus[name]
+            try:
+                reply = ecu.query(request)
+            except ds2.ProtocolError:
+                # Garbled reply, the line is fine - only serial / OS errors end the worker
+                continue
+            if reply is None:
+                continue
+            values = ecu.cache.decode(ecu.telegrams[request], reply, name)
+            pending.append((name, request, time.time(), values))
+        # Batches keep the pickling and pipe overhead off the per sample cost
+        if len(pending) >= batch or time.monotonic() - sent > 0.2:
+            output.put((port, pending))
+            pending = []
+            sent = time.monotonic()
+    if pending:
+        output.put((port, pending))
+
+class Worker(object):
+    def __init__(self, port):
+        self.port = port
+        self.process = None
+        self.restarts = 0
+        self.samples = 0
+        self.died = None
+
+class Fleet(object):
+    TABLES = ds2.TABLES
+
+    def __init__(self, ports=None, jobs=JOBS, parity=serial.PARITY_EVEN, restart_delay=2.0, batch=64, stop_timeout=10.0):
+        self.ports = ports if ports is not None else adapters()
+        self.jobs = jobs
+        self.parity = parity
+        self.restart_delay = restart_delay
+        self.stop_timeout = stop_timeout
+        self.batch = batch
+        self.workers = dict((port, Worker(port)) for port in self.ports)
+        self._output = multiprocessing.Queue()
+        self._stop = multiprocessing.Event()
+
+    def _start(self, worker):
+        worker.process = multiprocessing.Process(target=_worker, name="fleet " + worker.port,
+            args=(worker.port, self.parity, self.jobs, self._output, self._stop, self.batch))
+        worker.process.daemon = True
+        worker.process.start()
+        worker.died = None
+
+    def run(self, handler, duration=None):
+        """ handler(port, ecu, timestamp, { channel : value }) for every sample of every car """
+        if not self.workers:
+            print("No adapters found")
+            return
+        end = None if duration is None else time.monotonic() + duration
+        for worker in self.workers.values():
+            self._start(worker)
+        try:
+            while end is None or time.monotonic() < end:
+                self._collect(handler, 0.1)
+                self._supervise()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self._stop.set()
+            # A worker's last put only goes through while somebody reads the queue, keep
+            # reading until every worker has exited before joining them
+            deadline = time.monotonic() + self.stop_timeout
+            while any(worker.process.is_alive() for worker in self.workers.values()) and time.monotonic() < deadline:
+                self._collect(handler, 0.1)
+            for worker in self.workers.values():
+                if worker.process.is_alive():
+                    print(worker.port + " : worker did not stop, terminating")
+                    worker.process.terminate()
+                worker.process.join()
+            # What the workers flushed on their way out
+            self._collect(handler, 0)
+
+    def _collect(self, handler, timeout):
+        try:
+            port, samples = self._output.get(timeout=timeout)
+        except queue.Empty:
+            return
+        while True:
+            worker = self.workers[port]
+            worker.samples += len(samples)
+            for name, request, timestamp, values in samples:
+                table = self.TABLES[name][request]
+                handler(port, name, timestamp, dict((c.name, v) for c, v in zip(table.channels, values)))
+            try:
+                port, samples = self._output.get_nowait()
+            except queue.Empty:
+                return
+
+    def _supervise(self):
+        now = time.monotonic()
+        for worker in self.workers.values():
+            if worker.process.is_alive():
+                continue
+            if worker.died is None:
+                worker.died = now
+                print(worker.port + " : worker exited (" + str(worker.process.exitcode) + "), restarting")
+            elif now - worker.died >= self.restart_delay:
+                worker.restarts += 1
+                self._start(worker)
+
+    def summary(self):
+        return '\n'.join(worker.port + " : " + str(worker.samples) + " samples, " + str(worker.restarts) + " restarts"
+                         for worker in self.workers.values())
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Poll several cars at once, one process per cable")
+    parser.add_argument('ports', nargs='*', help="serial ports, all USB adapters if none given")
+    parser.add_argument('--duration', type=float)
+    args = parser.parse_args()
+
+    def show(port, ecu, timestamp, values):
+        print(port + " " + ecu + " {:.3f} ".format(timestamp) + ', '.join(k + "=" + str(v) for k, v in sorted(values.items())))
+
+    fleet = Fleet(args.ports or None)
+    fleet.run(show, args.duration)
+    print(fleet.summary())
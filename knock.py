@@ -0,0 +1,143 @@
+#-*-coding:utf-8 -*-
+#
+# Per cylinder knock and misfire analytics for ME7.2 - knock sensor
+# voltages (RKRN_W0..7, 22 40 00) and crankshaft roughness (LUTSFI1..8,
+# 22 40 03) followed sample by sample.
+#
+#   analyzer = Analyzer()
+#   Pipeline([(dme, b'\x22\x40\x00'), (dme, b'\x22\x40\x03')], consumer=analyzer.record).run()
+#
+#   analyzer.replay(recorder.Reader('drive.bin'))         # recorded session
+#
+# Each cylinder is compared with the mean of its bank (M62, cylinders 1-4
+# and 5-8). The deviation is learned into a baseline (Welford mean and
+# variance) over the first `warmup` samples and then followed with an
+# EWMA. A cylinder whose EWMA moves more than `threshold` baseline
+# standard deviations away raises a drift event, it is cleared again once
+# it is back within half of that. The work per sample is fixed.
+#
+
+import math
+
+import ds2
+
+KNOCK = 'knock'
+ROUGHNESS = 'roughness'
+
+CHANNELS = {
+    KNOCK: ['RKRN_W' + str(cylinder) for cylinder in range(8)],
+    ROUGHNESS: ['LUTSFI' + str(cylinder) for cylinder in range(1, 9)],
+}
+
+REQUESTS = {
+    b'\x22\x40\x00': KNOCK,
+    b'\x22\x40\x03': ROUGHNESS,
+}
+
+BANKS = [range(0, 4), range(4, 8)]
+
+class Event(object):
+    __slots__ = ('timestamp', 'kind', 'cylinder', 'drift', 'score', 'active')
+
+    def __init__(self, timestamp, kind, cylinder, drift, score, active):
+        self.timestamp = timestamp
+        self.kind = kind
+        self.cylinder = cylinder
+        self.drift = drift
+        self.score = score
+        self.active = active
+
+    def __repr__(self):
+        return "{:.3f} ".format(self.timestamp) + self.kind + " cylinder " + str(self.cylinder) + \
+            (" drifting " if self.active else " back ") + "{:+.4f} ({:.1f} sigma)".format(self.drift, self.score)
+
+class Cylinder(object):
+    __slots__ = ('count', 'mean', 'm2', 'ewma', 'drifting')
+
+    def __init__(self):
+        self.count = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+        self.ewma = None
+        self.drifting = False
+
+    def learn(self, deviation):
+        self.count += 1
+        delta = deviation - self.mean
+        self.mean += delta / self.count
+        self.m2 += delta * (deviation - self.mean)
+
+    @property
+    def std(self):
+        return math.sqrt(self.m2 / (self.count - 1)) if self.count > 1 else 0.0
+
+class Analyzer(object):
+    def __init__(self, warmup=100, alpha=0.05, threshold=4.0, floor=None, handler=None):
+        self.warmup = warmup
+        self.alpha = alpha
+        self.threshold = threshold
+        # Smallest sigma used for the score, a perfectly steady baseline would flag any noise
+        self.floor = floor or { KNOCK: 0.02, ROUGHNESS: 0.01 }
+        self.handler = handler or print
+        self.cylinders = dict((kind, [Cylinder() for i in range(8)]) for kind in CHANNELS)
+        self.samples = dict((kind, 0) for kind in CHANNELS)
+        self.events = 0
+
+    def update(self, kind, timestamp, values):
+        """ values per cylinder, 1 to 8 """
+        if any(value is None for value in values):
+            return
+        self.samples[kind] += 1
+        cylinders = self.cylinders[kind]
+        floor = self.floor[kind]
+        for bank in BANKS:
+            bank_mean = sum(values[i] for i in bank) / len(bank)
+            for i in bank:
+                deviation = values[i] - bank_mean
+                c = cylinders[i]
+                if c.count < self.warmup:
+                    c.learn(deviation)
+                    continue
+                c.ewma = deviation if c.ewma is None else c.ewma + self.alpha * (deviation - c.ewma)
+                drift = c.ewma - c.mean
+                score = abs(drift) / max(c.std, floor)
+                if not c.drifting and score > self.threshold:
+                    c.drifting = True
+                    self._event(timestamp, kind, i + 1, drift, score, True)
+                elif c.drifting and score < self.threshold / 2:
+                    c.drifting = False
+                    self._event(timestamp, kind, i + 1, drift, score, False)
+
+    def _event(self, timestamp, kind, cylinder, drift, score, active):
+        self.events += 1
+        self.handler(Event(timestamp, kind, cylinder, drift, score, active))
+
+    def _select(self, kind, channels, values):
+        by_name = dict((c.name, v) for c, v in zip(channels, values))
+        return [by_name.get(name) for name in CHANNELS[kind]]
+
+    def record(self, frame):
+        """ pipeline.Pipeline consumer """
+        request = bytes(frame.request)
+        if request not in REQUESTS or frame.reply is None:
+            return
+        kind = REQUESTS[request]
+        table = ds2.ME72_TELEGRAMS[request]
+        self.update(kind, frame.timestamp, self._select(kind, table.channels, table.decode(frame.reply)))
+
+    def replay(self, reader, start=None, end=None):
+        """ Run over a recorded session (recorder.Reader) """
+        for t, address, request, values in reader.decode(start, end):
+            kind = REQUESTS.get(request)
+            if address == ds2.DME and kind is not None:
+                self.update(kind, reader.started + t, [values.get(name) for name in CHANNELS[kind]])
+
+    def report(self):
+        lines = []
+        for kind in sorted(CHANNELS):
+            for i, c in enumerate(self.cylinders[kind]):
+                lines.append(kind + " cylinder " + str(i + 1) + " : baseline " + "{:+.4f}".format(c.mean) +
+                             " sd " + "{:.4f}".format(c.std) +
+                             (", trend " + "{:+.4f}".format(c.ewma) if c.ewma is not None else "") +
+                             (" DRIFTING" if c.drifting else ""))
+        return '\n'.join(lines)
@@ -0,0 +1,240 @@
+#-*-coding:utf-8 -*-
+#
+# Metrics endpoint - latest decoded values and bus statistics in the
+# Prometheus text format on a local HTTP port.
+#
+#   dme = ME72()
+#   egs = ZF5HP24(bus=dme)
+#   metrics = Metrics(dme.stats)
+#   metrics.serve(9100)
+#   Pipeline([(dme, b'\x22\x40\x00'), (egs, b'\x0B\x03'), (egs, b'\x04\x01')], consumer=metrics.record).run()
+#
+#   python metrics.py --listen 9100
+#   curl http://127.0.0.1:9100/metrics
+#
+# Every signal of ds2.SIGNALS is exported as bmw_<signal>{ecu="..."},
+# knock and roughness as bmw_knock / bmw_roughness with a cylinder label,
+# the EGS fault memory count as bmw_dtc_count. The gear code of the 0B 03
+# block is exported as the gear number, -1 in reverse, codes the table does
+# not know leave no sample. The polling side only stores the latest value
+# per series, a scrape renders a copy of them on the server thread and
+# never touches the serial port.
+#
+
+import threading
+import time
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import ds2
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+# Bus counters, Counters attribute -> metric
+COUNTERS = [
+    ('requests', 'bmw_requests_total', "Requests sent"),
+    ('timeouts', 'bmw_timeouts_total', "Requests without reply"),
+    ('echo_timeouts', 'bmw_echo_timeouts_total', "Requests without K-line echo"),
+    ('busy', 'bmw_busy_total', "Busy replies"),
+    ('negative', 'bmw_negative_total', "Negative replies"),
+    ('checksum_errors', 'bmw_checksum_errors_total', "Frames with invalid checksum"),
+]
+
+# The gear channel carries a code, its text says which gear that is
+GEAR_TEXT = dict(next(c.text for c in ds2.ZF5HP24_TELEGRAMS[b'\x0B\x03'].channels if c.name == 'gear'))
+GEAR_NUMBERS = { 'reverse' : -1, 'neutral' : 0 }
+
+def _gear(code):
+    """ Gear number of the EGS gear code, None if the code is not known """
+    text = GEAR_TEXT.get(code)
+    if text is None:
+        return None
+    return int(text) if text.isdigit() else GEAR_NUMBERS.get(text)
+
+# metric -> raw value to exported value, None drops the sample
+CONVERSIONS = {
+    'bmw_gear' : _gear,
+}
+
+def _series(signal):
+    """ (metric, extra label) of a ds2.SIGNALS name """
+    for prefix in ('knock_cyl', 'roughness_cyl'):
+        if signal.startswith(prefix):
+            return 'bmw_' + prefix[:-4], 'cylinder="' + signal[len(prefix):] + '"'
+    return 'bmw_' + signal, None
+
+def _labels(*labels):
+    labels = [label for label in labels if label]
+    return '{' + ','.join(labels) + '}' if labels else ''
+
+class Metrics(object):
+    def __init__(self, stats=None, signals=ds2.SIGNALS):
+        self.stats = stats
+        self.scrapes = 0
+        # Series line prefix -> latest value, replaced item by item by the polling side
+        self._values = {}
+        self._help = {}
+        self._channels = {}
+        self._signals = {}
+        for signal, sources in signals.items():
+            metric, label = _series(signal)
+            self._help[metric] = metric[4:].replace('_', ' ') + (" per cylinder" if label else "")
+            for i, (ecu, channel) in enumerate(sources):
+                key = metric + _labels('ecu="' + ecu + '"', label)
+                self._channels[(ecu, channel)] = key
+                # Scheduler values are merged by signal, they come from the first source
+                if i == 0:
+                    self._signals[signal] = key
+        self._help['bmw_gear'] = "gear, -1 reverse"
+        self._help['bmw_dtc_count'] = "fault memory entries"
+        self._help['bmw_last_update_timestamp_seconds'] = "wall clock time of the latest reply"
+        self._server = None
+
+    def update(self, ecu, channel, value, timestamp=None):
+        key = self._channels.get((ecu, channel))
+        if key is None:
+            return
+        if not self._set(key, value):
+            return
+        self._values['bmw_last_update_timestamp_seconds{ecu="' + ecu + '"}'] = timestamp or time.time()
+
+    def record(self, frame):
+        """ pipeline.Pipeline consumer """
+        ecu = frame.ecu
+        if frame.reply is None or ecu.NAME is None:
+            return
+        request = bytes(frame.request)
+        if ecu.ADDRESS == ds2.EGS and request == b'\x04\x01':
+            # 32 len a0 <count> ...
+            self._values['bmw_dtc_count{ecu="' + ecu.NAME + '"}'] = frame.reply[3]
+            return
+        table = ecu.telegrams.get(request)
+        if table is None:
+            return
+        for channel, value in zip(table.channels, ecu.cache.decode(table, frame.reply, ecu.NAME)):
+            self.update(ecu.NAME, channel.name, value, frame.timestamp)
+
+    def sample(self, sample):
+        """ telegram.Sample from K_Line.samples() """
+        self.update(sample.ecu, sample.channel, sample.value, sample.timestamp)
+
+    def handle(self, timestamp, values):
+        """ Scheduler.run handler, { signal : value } """
+        for signal, value in values.items():
+            key = self._signals.get(signal)
+            if key is not None:
+                self._set(key, value)
+
+    def _set(self, key, value):
+        """ False if there is nothing to export """
+        convert = CONVERSIONS.get(key.split('{', 1)[0])
+        if convert is not None and value is not None:
+            value = convert(value)
+            if value is None:
+                # Unknown code, no sample rather than a stale one
+                self._values.pop(key, None)
+        if value is None:
+            return False
+        self._values[key] = value
+        return True
+
+    def render(self):
+        self.scrapes += 1
+        values = dict(self._values)
+        lines = []
+        metric = None
+        for key in sorted(values):
+            name = key.split('{', 1)[0]
+            if name != metric:
+                metric = name
+                lines.append('# HELP ' + name + ' ' + self._help.get(name, name))
+                lines.append('# TYPE ' + name + ' gauge')
+            lines.append(key + ' ' + repr(float(values[key])))
+        if self.stats is not None:
+            lines.extend(self._render_stats())
+        return '\n'.join(lines) + '\n'
+
+    def _render_stats(self):
+        stats = self.stats
+        items = stats.items()
+        lines = []
+        for attribute, name, text in COUNTERS:
+            lines.append('# HELP ' + name + ' ' + text)
+            lines.append('# TYPE ' + name + ' counter')
+            for (address, service), c in items:
+                lines.append(name + self._key(address, service) + ' ' + str(getattr(c, attribute)))
+        for attribute, name, text in [('echo', 'bmw_echo_latency_seconds', "Request to echo"),
+                                      ('reply', 'bmw_reply_latency_seconds', "Echo to reply")]:
+            lines.append('# HELP ' + name + ' ' + text)
+            lines.append('# TYPE ' + name + ' histogram')
+            for (address, service), c in items:
+                histogram = getattr(c, attribute)
+                ecu = 'ecu="' + stats.name(address) + '",service="' + '{:02x}'.format(service) + '"'
+                for bound, count in histogram.cumulative():
+                    lines.append(name + '_bucket{' + ecu + ',le="' + repr(bound) + '"}' + ' ' + str(count))
+                lines.append(name + '_bucket{' + ecu + ',le="+Inf"}' + ' ' + str(histogram.count))
+                lines.append(name + '_sum{' + ecu + '} ' + repr(histogram.sum))
+                lines.append(name + '_count{' + ecu + '} ' + str(histogram.count))
+        for name, value in [('bmw_bytes_sent_total', stats.bytes_sent), ('bmw_bytes_received_total', stats.bytes_received)]:
+            lines.append('# TYPE ' + name + ' counter')
+            lines.append(name + ' ' + str(value))
+        return lines
+
+    def _key(self, address, service):
+        return '{ecu="' + self.stats.name(address) + '",service="' + '{:02x}'.format(service) + '"}'
+
+    def serve(self, port=9100, host='127.0.0.1'):
+        """ HTTP server on a daemon thread, GET /metrics """
+        metrics = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split('?', 1)[0] not in ('/', '/metrics'):
+                    self.send_error(404)
+                    return
+                body = metrics.render().encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', CONTENT_TYPE)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self._server = ThreadingHTTPServer((host, port), Handler)
+        self._server.daemon_threads = True
+        thread = threading.Thread(target=self._server.serve_forever, name="metrics")
+        thread.daemon = True
+        thread.start()
+        return self._server.server_address
+
+    def close(self):
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+
+if __name__ == '__main__':
+    import argparse
+
+    from pipeline import Pipeline
+
+    parser = argparse.ArgumentParser(description="Poll DME and EGS and serve the values to Prometheus")
+    parser.add_argument('--port', default=ds2.DEFAULT_PORT, help="serial port")
+    parser.add_argument('--listen', type=int, default=9100, help="HTTP port")
+    parser.add_argument('--host', default='127.0.0.1')
+    args = parser.parse_args()
+
+    dme = ds2.ME72(port=args.port)
+    egs = ds2.ZF5HP24(bus=dme)
+    metrics = Metrics(dme.stats)
+    host, port = metrics.serve(args.listen, args.host)
+    print("Metrics on http://" + host + ":" + str(port) + "/metrics")
+    jobs = [(dme, b'\x22\x40\x00'), (dme, b'\x22\x40\x03'), (dme, b'\x22\x40\x04'), (egs, b'\x0B\x03'), (egs, b'\x04\x01')]
+    try:
+        Pipeline(jobs, consumer=metrics.record).run()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        metrics.close()
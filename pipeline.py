@@ -0,0 +1,138 @@
+#-*-coding:utf-8 -*-
+#
+# Producer / consumer split - the serial loop runs on its own thread and
+# only moves frames, decoding and printing happen on a worker thread so a
+# slow terminal or disk never holds up the K-line.
+#
+#   dme = ME72()
+#   p = Pipeline([(dme, b'\x22\x40\x00'), (dme, b'\x21\x13')])
+#   p.run(cycles=100)
+#
+# Frames are handed over through a bounded queue. When the worker falls
+# behind the I/O thread waits up to `backpressure` seconds for a free
+# slot, after that the oldest queued frame is dropped and counted.
+#
+
+import queue
+import threading
+import time
+
+from ds2 import ProtocolError
+
+class Frame(object):
+    # timestamp is wall clock, monotonic the same moment on time.monotonic()
+    __slots__ = ('timestamp', 'ecu', 'request', 'reply', 'monotonic')
+
+    def __init__(self, timestamp, ecu, request, reply, monotonic=None):
+        self.timestamp = timestamp
+        self.ecu = ecu
+        self.request = request
+        self.reply = reply
+        self.monotonic = monotonic
+
+def dump(frame):
+    """ Default consumer - hex dump plus the ECU's own decode """
+    ecu = frame.ecu
+    print("{:.3f} ".format(frame.timestamp) + type(ecu).__name__ + " " +
+          ''.join('{:02x} '.format(x) for x in bytearray(frame.request)))
+    if frame.reply is None:
+        print("No response")
+        return
+    print("RX : " + ''.join('{:02x} '.format(x) for x in bytearray(frame.reply)))
+    if hasattr(ecu, 'decode'):
+        ecu.decode(frame.request, frame.reply)
+
+class Pipeline(object):
+    _STOP = object()
+
+    def __init__(self, jobs, consumer=dump, size=256, backpressure=0.01):
+        self.jobs = [(ecu, bytes(request)) for ecu, request in jobs]
+        self.consumer = consumer
+        self.backpressure = backpressure
+        self.queue = queue.Queue(size)
+        self.produced = 0
+        self.consumed = 0
+        self.dropped = 0
+        # Protocol errors on the line and exceptions in the consumer
+        self.errors = 0
+        self._running = False
+        self._io = None
+        self._worker = None
+
+    def start(self, cycles=None, duration=None):
+        self._running = True
+        self._io = threading.Thread(target=self._produce, args=(cycles, duration), name="k-line io")
+        self._worker = threading.Thread(target=self._consume, name="decode")
+        self._worker.daemon = True
+        self._worker.start()
+        self._io.start()
+
+    def stop(self):
+        self._running = False
+
+    def join(self):
+        self._io.join()
+        self._worker.join()
+
+    def run(self, cycles=None, duration=None):
+        self.start(cycles, duration)
+        try:
+            while self._io.is_alive():
+                self._io.join(0.5)
+        except KeyboardInterrupt:
+            self.stop()
+        self.join()
+        print(self.summary())
+
+    def summary(self):
+        return str(self.produced) + " frames, " + str(self.consumed) + " decoded, " + \
+            str(self.dropped) + " dropped, " + str(self.errors) + " errors"
+
+    def _produce(self, cycles, duration):
+        end = None if duration is None else time.monotonic() + duration
+        cycle = 0
+        try:
+            while self._running and (cycles is None or cycle < cycles):
+                for ecu, request in self.jobs:
+                    if not self._running or (end is not None and time.monotonic() >= end):
+                        return
+                    try:
+                        reply = ecu.query(request)
+                    except ProtocolError as e:
+                        # Line noise, the next request is a new chance
+                        self.errors += 1
+                        print("Protocol error : " + str(e))
+                        continue
+                    # Copy out of the reader buffer, it is reused by the next read
+                    self._put(Frame(time.time(), ecu, request, None if reply is None else bytes(reply), time.monotonic()))
+                cycle += 1
+        finally:
+            self._running = False
+            self.queue.put(self._STOP)
+
+    def _put(self, frame):
+        self.produced += 1
+        try:
+            self.queue.put(frame, timeout=self.backpressure)
+            return
+        except queue.Full:
+            pass
+        # Keep the newest frame, the oldest one is already stale
+        try:
+            self.queue.get_nowait()
+            self.dropped += 1
+        except queue.Empty:
+            pass
+        self.queue.put_nowait(frame)
+
+    def _consume(self):
+        while True:
+            frame = self.queue.get()
+            if frame is self._STOP:
+                return
+            try:
+                self.consumer(frame)
+            except Exception as e:
+                self.errors += 1
+                print("Decode error : " + str(e))
+            self.consumed += 1
@@ -0,0 +1,99 @@
+#-*-coding:utf-8 -*-
+#
+# Query planner - maps requested signals to the smallest set of telegrams
+# across DME and EGS and decodes only the fields that were asked for.
+#
+#   p = planner.plan(['engine_rpm', 'transmission_temp', 'knock_cyl3'])
+#   values = p.poll({ 'DME' : ME72(), 'EGS' : ZF5HP24() })
+#
+
+import telegram
+from ds2 import SIGNALS, TABLES
+
+class Step(object):
+    def __init__(self, ecu, request, channels, signals):
+        self.ecu = ecu
+        self.request = request
+        # Only the needed fields, compiled into their own struct
+        self.telegram = telegram.Telegram(request, channels)
+        # A channel can answer several signals (alias and table name)
+        self.signals = [signals[c.name] for c in self.telegram.channels]
+
+    def __repr__(self):
+        return self.ecu + " " + ' '.join('{:02x}'.format(x) for x in bytearray(self.request)) + " -> " + \
+            ', '.join(s for names in self.signals for s in names)
+
+class Plan(object):
+    def __init__(self, steps):
+        self.steps = steps
+
+    def poll(self, ecus):
+        """ One pass over the plan, ecus maps 'DME' / 'EGS' to connected ECU objects """
+        result = {}
+        for step in self.steps:
+            reply = ecus[step.ecu].query(step.request)
+            if reply is None:
+                values = [None] * len(step.signals)
+            else:
+                values = step.telegram.decode(reply)
+            for names, value in zip(step.signals, values):
+                for name in names:
+                    result[name] = value
+        return result
+
+    def __len__(self):
+        return len(self.steps)
+
+    def __repr__(self):
+        return '\n'.join(repr(step) for step in self.steps)
+
+def _sources(signal, signals, tables):
+    """ [(ecu, request, channel)] that can answer signal, preferred first """
+    if signal in signals:
+        wanted = signals[signal]
+    else:
+        # Plain table names (NMOT_W, LUTSFI3, ...) work too
+        wanted = [(ecu, signal) for ecu in sorted(tables)]
+    result = []
+    for ecu, name in wanted:
+        for request, table in tables[ecu].items():
+            for channel in table.channels:
+                if channel.name == name:
+                    result.append((ecu, request, channel))
+    return result
+
+def plan(names, signals=SIGNALS, tables=TABLES):
+    candidates = {}
+    for name in names:
+        sources = _sources(name, signals, tables)
+        if not sources:
+            raise ValueError("unknown signal " + name)
+        candidates[name] = sources
+
+    # Greedy set cover - take the telegram answering most open signals,
+    # ties go to the telegram holding the more preferred sources
+    uncovered = list(dict.fromkeys(names))
+    steps = []
+    while uncovered:
+        covers = {}
+        for name in uncovered:
+            for rank, (ecu, request, channel) in enumerate(candidates[name]):
+                key = (ecu, request)
+                if key not in covers:
+                    covers[key] = [0, 0]
+                covers[key][0] += 1
+                covers[key][1] -= rank
+        ecu, request = max(sorted(covers), key=lambda k: covers[k])
+        channels = []
+        assigned = {}
+        for name in list(uncovered):
+            for source_ecu, source_request, channel in candidates[name]:
+                if (source_ecu, source_request) == (ecu, request):
+                    if channel.name not in assigned:
+                        assigned[channel.name] = []
+                        channels.append(channel)
+                    assigned[channel.name].append(name)
+                    uncovered.remove(name)
+                    break
+        steps.append(Step(ecu, request, channels, assigned))
+    return Plan(steps)
@@ -0,0 +1,238 @@
+#-*-coding:utf-8 -*-
+#
+# Session recorder - raw frames in an append-only binary log with a sparse
+# time index, read back through mmap.
+#
+#   rec = Recorder('drive.bin')
+#   Pipeline(jobs, consumer=rec.record).run(duration=4 * 3600)
+#   rec.close()
+#
+#   log = Reader('drive.bin')
+#   for timestamp, address, request, values in log.decode(600, 660):
+#       ...
+#   rpm = log.columns(DME, b'\x22\x40\x00')['NMOT_W']   # numpy
+#
+# drive.bin
+#   header  'BMWLOG' version(H) started(d)          wall clock of t = 0
+#   record  t(d) address(B) request size(B) frame size(H) request frame
+#
+# drive.bin.idx
+#   entry   t(d) offset(Q)                          one every `interval` seconds
+#
+# t is seconds since the session start on the monotonic clock. The index
+# only ever points at record boundaries, without it a seek scans the log
+# from the start.
+#
+
+import mmap
+import os
+import struct
+import time
+from bisect import bisect_right
+
+import ds2
+import telegram
+
+MAGIC = b'BMWLOG'
+VERSION = 1
+HEADER = struct.Struct('<6sHd')
+RECORD = struct.Struct('<dBBH')
+INDEX = struct.Struct('<dQ')
+
+class Recorder(object):
+    def __init__(self, path, interval=1.0):
+        self.path = path
+        self.interval = interval
+        self.records = 0
+        exists = os.path.exists(path) and os.path.getsize(path) >= HEADER.size
+        if exists:
+            with open(path, 'rb') as f:
+                magic, version, self.started = HEADER.unpack(f.read(HEADER.size))
+            if magic != MAGIC or version != VERSION:
+                raise ValueError(path + " is not a session log")
+        else:
+            self.started = time.time()
+        self._file = open(path, 'ab')
+        self._index = open(path + '.idx', 'ab')
+        if not exists:
+            self._file.write(HEADER.pack(MAGIC, VERSION, self.started))
+        # Appending to an older session continues its time line
+        self._origin = time.monotonic() - (time.time() - self.started)
+        self._offset = self._file.tell()
+        self._next_index = None
+
+    def write(self, address, request, frame, timestamp=None, monotonic=None):
+        """
+            monotonic is time.monotonic() of the frame, timestamp wall clock
+            (time.time()) for frames from elsewhere - now if neither is given.
+            Wall clock steps (NTP, manual) make t jump, prefer monotonic.
+        """
+        if monotonic is not None:
+            t = monotonic - self._origin
+        elif timestamp is not None:
+            t = timestamp - self.started
+        else:
+            t = time.monotonic() - self._origin
+        if self._next_index is None or t >= self._next_index:
+            self._index.write(INDEX.pack(t, self._offset))
+            self._next_index = t + self.interval
+        record = RECORD.pack(t, address, len(request), len(frame)) + bytes(request) + bytes(frame)
+        self._file.write(record)
+        self._offset += len(record)
+        self.records += 1
+
+    def record(self, frame):
+        """ pipeline.Pipeline consumer """
+        if frame.reply is not None:
+            self.write(frame.ecu.ADDRESS, frame.request, frame.reply, frame.timestamp, frame.monotonic)
+
+    def flush(self):
+        self._file.flush()
+        self._index.flush()
+
+    def close(self):
+        self._file.close()
+        self._index.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+class Reader(object):
+    TABLES = {
+        ds2.DME: ds2.ME72_TELEGRAMS,
+        ds2.EGS: ds2.ZF5HP24_TELEGRAMS,
+    }
+
+    def __init__(self, path):
+        self.path = path
+        self._file = open(path, 'rb')
+        self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, self.started = HEADER.unpack_from(self._map, 0)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError(path + " is not a session log")
+        self._times, self._offsets = self._load_index()
+
+    def _load_index(self):
+        times = []
+        offsets = []
+        size = len(self._map)
+        try:
+            with open(self.path + '.idx', 'rb') as f:
+                data = f.read()
+        except IOError:
+            data = b''
+        for t, offset in INDEX.iter_unpack(data[:len(data) - len(data) % INDEX.size]):
+            if offset >= size:
+                break
+            times.append(t)
+            offsets.append(offset)
+        if not offsets:
+            times, offsets = [0.0], [HEADER.size]
+        return times, offsets
+
+    def _records(self, offset):
+        m = self._map
+        size = len(m)
+        while offset + RECORD.size <= size:
+            t, address, request_size, frame_size = RECORD.unpack_from(m, offset)
+            start = offset + RECORD.size
+            end = start + request_size + frame_size
+            if end > size:
+                return # cut short by a crash
+            yield t, address, start, request_size, end
+            offset = end
+
+    def frames(self, start=None, end=None):
+        """ (t, address, request, frame) with start <= t < end, request and frame are views into the map, a view kept past close() keeps the map alive """
+        view = memoryview(self._map)
+        offset = self._offsets[0]
+        if start is not None:
+            offset = self._offsets[max(bisect_right(self._times, start) - 1, 0)]
+        for t, address, data, request_size, stop in self._records(offset):
+            if start is not None and t < start:
+                continue
+            if end is not None and t >= end:
+                return
+            yield t, address, view[data:data + request_size], view[data + request_size:stop]
+
+    def decode(self, start=None, end=None, tables=None):
+        """ (t, address, request, { channel : value }) for every frame with a known telegram """
+        tables = tables or self.TABLES
+        for t, address, request, frame in self.frames(start, end):
+            telegrams = tables.get(address)
+            if telegrams is None:
+                continue
+            table = telegrams.get(bytes(request))
+            if table is None:
+                continue
+            yield t, address, bytes(request), dict((c.name, v) for c, v in zip(table.channels, table.decode(frame)))
+
+    def columns(self, address, request, start=None, end=None, tables=None):
+        """ One telegram over a time range as numpy arrays, 't' plus one per channel - pandas.DataFrame(...) ready """
+        table = (tables or self.TABLES)[address][bytes(request)]
+        request = bytes(request)
+        times = []
+        data = bytearray()
+        width = None
+        for t, frame_address, frame_request, frame in self.frames(start, end):
+            if frame_address != address or frame_request != request:
+                continue
+            # The first frame sets the width, variants answering with another block length are left out
+            if width is None:
+                width = len(frame)
+            if len(frame) == width:
+                times.append(t)
+                data += frame
+        result = table.decode_batch(bytes(data), width or len(table))
+        result['t'] = telegram.numpy.array(times)
+        return result
+
+    def replay(self, ecus, start=None, end=None):
+        """ Print the range through the ECU decoders, ecus maps address to ME72 / ZF5HP24 objects """
+        for t, address, request, frame in self.frames(start, end):
+            if address in ecus:
+                print("{:.3f}".format(t))
+                ecus[address].decode(bytes(request), frame)
+
+    @property
+    def duration(self):
+        last = self._times[-1]
+        for t, address, start, request_size, end in self._records(self._offsets[-1]):
+            last = t
+        return last
+
+    def close(self):
+        if self._map is None:
+            return
+        try:
+            self._map.close()
+        except BufferError:
+            # Views from frames() are still held, the map is unmapped with the last of them
+            pass
+        self._map = None
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Decode a recorded session")
+    parser.add_argument('path')
+    parser.add_argument('--start', type=float, help="seconds since the session start")
+    parser.add_argument('--end', type=float)
+    args = parser.parse_args()
+
+    with Reader(args.path) as log:
+        print(time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(log.started)) + ", " +
+              "{:.0f}".format(log.duration) + " sec")
+        for t, address, request, values in log.decode(args.start, args.end):
+            print("{:.3f} {:02x} ".format(t, address) + request.hex() + " " +
+                  ', '.join(k + "=" + str(v) for k, v in sorted(values.items())))
@@ -0,0 +1,166 @@
+#-*-coding:utf-8 -*-
+#
+# Live telemetry - the last N samples (and optionally only the last
+# `window` seconds) of every channel in fixed size arrays, with rolling
+# min / max / mean / variance kept up to date on every sample.
+#
+#   live = Telemetry(LIVE, capacity=600, window=60)
+#   Pipeline(jobs, consumer=live.record).start()
+#   ...
+#   rpm = live['NMOT_W']
+#   print(rpm.mean, rpm.max, rpm.std)
+#   older, newer = rpm.views()             # memoryviews, oldest first
+#
+# Memory is allocated once per channel, a full day of polling uses the
+# same as the first minute. Mean and variance are a Welford sum that
+# samples are added to and taken out of, min / max are monotonic queues,
+# all amortized O(1) per sample.
+#
+
+import math
+from array import array
+from collections import deque
+
+# Channels of the live view, table names
+LIVE = ['NMOT_W', 'transmission_temp'] + \
+    ['RKRN_W' + str(cylinder) for cylinder in range(8)] + \
+    ['LUTSFI' + str(cylinder) for cylinder in range(1, 9)]
+
+class RingBuffer(object):
+    def __init__(self, capacity, window=None):
+        self.capacity = capacity
+        self.window = window
+        self._values = array('d', bytes(8 * capacity))
+        self._times = array('d', bytes(8 * capacity))
+        self._start = 0
+        self._count = 0
+        self._total = 0
+        self._mean = 0.0
+        self._m2 = 0.0
+        # (sequence, value), increasing / decreasing
+        self._min = deque()
+        self._max = deque()
+
+    def append(self, value, timestamp):
+        if value is None:
+            return
+        if self.window is not None:
+            while self._count and self._times[self._start] < timestamp - self.window:
+                self._evict()
+        if self._count == self.capacity:
+            self._evict()
+        i = (self._start + self._count) % self.capacity
+        self._values[i] = value
+        self._times[i] = timestamp
+        self._count += 1
+        sequence = self._total
+        self._total += 1
+
+        delta = value - self._mean
+        self._mean += delta / self._count
+        self._m2 += delta * (value - self._mean)
+
+        while self._min and self._min[-1][1] >= value:
+            self._min.pop()
+        self._min.append((sequence, value))
+        while self._max and self._max[-1][1] <= value:
+            self._max.pop()
+        self._max.append((sequence, value))
+
+    def _evict(self):
+        value = self._values[self._start]
+        sequence = self._total - self._count
+        self._start = (self._start + 1) % self.capacity
+        self._count -= 1
+        if self._count:
+            delta = value - self._mean
+            self._mean -= delta / self._count
+            self._m2 = max(self._m2 - delta * (value - self._mean), 0.0)
+        else:
+            self._mean = 0.0
+            self._m2 = 0.0
+        if self._min and self._min[0][0] == sequence:
+            self._min.popleft()
+        if self._max and self._max[0][0] == sequence:
+            self._max.popleft()
+
+    def __len__(self):
+        return self._count
+
+    @property
+    def last(self):
+        if not self._count:
+            return None
+        return self._values[(self._start + self._count - 1) % self.capacity]
+
+    @property
+    def min(self):
+        return self._min[0][1] if self._min else None
+
+    @property
+    def max(self):
+        return self._max[0][1] if self._max else None
+
+    @property
+    def mean(self):
+        return self._mean if self._count else None
+
+    @property
+    def variance(self):
+        return self._m2 / (self._count - 1) if self._count > 1 else None
+
+    @property
+    def std(self):
+        variance = self.variance
+        return None if variance is None else math.sqrt(variance)
+
+    def views(self, times=False):
+        """ (older, newer) memoryviews of the values, oldest first - only valid until the next append """
+        data = memoryview(self._times if times else self._values)
+        end = self._start + self._count
+        if end <= self.capacity:
+            return data[self._start:end], data[0:0]
+        return data[self._start:], data[:end - self.capacity]
+
+    def values(self):
+        """ Copy of the values, oldest first """
+        older, newer = self.views()
+        return array('d', older) + array('d', newer)
+
+    def times(self):
+        older, newer = self.views(times=True)
+        return array('d', older) + array('d', newer)
+
+class Telemetry(object):
+    """ One RingBuffer per channel, fed by the decoders """
+    def __init__(self, names=None, capacity=1024, window=None):
+        self.capacity = capacity
+        self.window = window
+        self._names = None if names is None else set(names)
+        self.buffers = dict((name, RingBuffer(capacity, window)) for name in (names or []))
+
+    def add(self, name, value, timestamp):
+        buffer = self.buffers.get(name)
+        if buffer is None:
+            if self._names is not None:
+                return
+            buffer = self.buffers[name] = RingBuffer(self.capacity, self.window)
+        buffer.append(value, timestamp)
+
+    def sample(self, sample):
+        """ telegram.Sample from K_Line.samples() """
+        self.add(sample.channel, sample.value, sample.timestamp)
+
+    def record(self, frame):
+        """ pipeline.Pipeline consumer """
+        table = frame.ecu.telegrams.get(bytes(frame.request))
+        if table is None or frame.reply is None:
+            return
+        for channel, value in zip(table.channels, table.decode(frame.reply)):
+            self.add(channel.name, value, frame.timestamp)
+
+    def __getitem__(self, name):
+        return self.buffers[name]
+
+    def __contains__(self, name):
+        return name in self.buffers
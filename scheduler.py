@@ -0,0 +1,194 @@
+#-*-coding:utf-8 -*-
+#
+# Bus scheduler - one owner of the K-line interleaving DME (KWP2000) and
+# EGS (DS2) requests by per-signal target rates.
+#
+#   s = Scheduler()
+#   s.add(['engine_rpm', 'gear'], rate=10)
+#   s.add(['coolant_temp', 'transmission_temp'], rate=1)
+#   s.once('EGS', b'\x04\x01', handler) # fault memory on demand
+#   s.run(handler, duration=60)
+#
+# Signals living in the same telegram share one task running at the
+# highest rate asked for. Due tasks are served by priority, then by the
+# earliest release. A release that is served after the next one was due
+# counts as a deadline miss and the skipped releases are dropped rather
+# than bursting to catch up. One-shot jobs gain a priority level for every
+# `JOB_AGING` seconds they wait, a saturated bus always has an overdue
+# task and would never get to them otherwise.
+#
+
+import time
+
+import planner
+from ds2 import ME72, ZF5HP24, ProtocolError
+
+class Task(object):
+    def __init__(self, step, period, priority):
+        self.step = step
+        self.period = period
+        self.base_period = period
+        self.boost_until = None
+        self.priority = priority
+        self.due = 0.0
+        self.runs = 0
+        self.misses = 0
+        self.errors = 0
+        self.lateness = 0.0
+
+    def merge(self, step, period, priority):
+        assigned = dict((c.name, list(names)) for c, names in zip(self.step.telegram.channels, self.step.signals))
+        channels = list(self.step.telegram.channels)
+        for c, names in zip(step.telegram.channels, step.signals):
+            if c.name not in assigned:
+                assigned[c.name] = []
+                channels.append(c)
+            assigned[c.name].extend(n for n in names if n not in assigned[c.name])
+        self.step = planner.Step(self.step.ecu, self.step.request, channels, assigned)
+        self.period = min(self.period, period)
+        self.base_period = min(self.base_period, period)
+        self.priority = max(self.priority, priority)
+
+    def __repr__(self):
+        return repr(self.step) + " @ " + "{:g}".format(1.0 / self.base_period) + " Hz"
+
+class Job(object):
+    """ One-shot request (adaptations, fault memory, ...) """
+    def __init__(self, ecu, payload, handler, priority):
+        self.ecu = ecu
+        self.payload = bytes(payload)
+        self.handler = handler
+        self.priority = priority
+        self.due = time.monotonic()
+
+class Scheduler(object):
+    JOB_AGING = 0.5
+
+    def __init__(self, ecus=None):
+        if ecus is None:
+            dme = ME72()
+            ecus = { 'DME' : dme, 'EGS' : ZF5HP24(bus=dme) }
+        self.ecus = ecus
+        self.tasks = {}
+        self._jobs = []
+        # Garbled one-shot replies, the periodic ones are counted per task
+        self.job_errors = 0
+        self._running = False
+        self._started = None
+
+    def add(self, signals, rate, priority=0):
+        period = 1.0 / rate
+        for step in planner.plan(signals).steps:
+            key = (step.ecu, step.request)
+            if key in self.tasks:
+                self.tasks[key].merge(step, period, priority)
+            else:
+                self.tasks[key] = Task(step, period, priority)
+
+    def boost(self, signals, rate, duration):
+        """ Poll the telegrams carrying any of signals at rate for the next duration seconds """
+        now = time.monotonic()
+        signals = set(signals)
+        for task in self.tasks.values():
+            if any(name in signals for names in task.step.signals for name in names):
+                task.period = min(task.base_period, 1.0 / rate)
+                task.boost_until = max(task.boost_until or now, now + duration)
+                task.due = min(task.due, now)
+
+    def once(self, ecu, payload, handler, priority=0):
+        """ handler(timestamp, reply) with reply copied out of the frame buffer, None on timeout or a garbled reply """
+        self._jobs.append(Job(ecu, payload, handler, priority))
+
+    def stop(self):
+        self._running = False
+
+    def run(self, handler, duration=None):
+        """ handler(timestamp, { signal : value }) for every periodic reply """
+        self._running = True
+        self._started = time.monotonic()
+        end = None if duration is None else self._started + duration
+        for task in self.tasks.values():
+            task.due = self._started
+        while self._running and (end is None or time.monotonic() < end):
+            now = time.monotonic()
+            due = [t for t in self.tasks.values() if t.due <= now] + self._jobs
+            if not due:
+                if not self.tasks:
+                    break
+                wake = min(t.due for t in self.tasks.values())
+                if end is not None:
+                    wake = min(wake, end)
+                time.sleep(max(wake - now, 0))
+                continue
+            item = max(due, key=lambda t: (self._priority(t, now), -t.due))
+            if isinstance(item, Job):
+                self._jobs.remove(item)
+                try:
+                    reply = self.ecus[item.ecu].query(item.payload)
+                except ProtocolError as e:
+                    self.job_errors += 1
+                    print("Protocol error : " + str(e))
+                    reply = None
+                item.handler(time.time(), None if reply is None else bytes(reply))
+            else:
+                self._serve(item, now, handler)
+
+    def _priority(self, item, now):
+        if isinstance(item, Job):
+            return item.priority + (now - item.due) / self.JOB_AGING
+        return item.priority
+
+    def _serve(self, task, now, handler):
+        if task.boost_until is not None and now >= task.boost_until:
+            task.period = task.base_period
+            task.boost_until = None
+        late = now - task.due
+        skipped = int(late / task.period)
+        task.misses += skipped
+        task.lateness = max(task.lateness, late)
+        task.due += (skipped + 1) * task.period
+        task.runs += 1
+
+        step = task.step
+        try:
+            reply = self.ecus[step.ecu].query(step.request)
+        except ProtocolError as e:
+            # One garbled reply, the next release asks again
+            task.errors += 1
+            print("Protocol error : " + str(e))
+            return
+        timestamp = time.time()
+        values = [None] * len(step.signals) if reply is None else step.telegram.decode(reply)
+        result = {}
+        for names, value in zip(step.signals, values):
+            for name in names:
+                result[name] = value
+        handler(timestamp, result)
+
+    def report(self):
+        elapsed = time.monotonic() - self._started if self._started else 0.0
+        lines = []
+        for task in sorted(self.tasks.values(), key=lambda t: t.period):
+            achieved = task.runs / elapsed if elapsed > 0 else 0.0
+            lines.append(repr(task) + " : " + "{:.1f}".format(achieved) + " Hz, " + str(task.runs) + " runs, " +
+                         str(task.misses) + " missed, " + str(task.errors) + " errors, max late " +
+                         "{:.0f}".format(task.lateness * 1000) + " ms")
+        if self.job_errors:
+            lines.append("one-shot requests : " + str(self.job_errors) + " errors")
+        return '\n'.join(lines)
+
+if __name__ == '__main__':
+    def show(timestamp, values):
+        print("{:.3f} ".format(timestamp) + ', '.join(k + "=" + str(v) for k, v in sorted(values.items())))
+
+    def show_errors(timestamp, reply):
+        print("fault memory : " + ('' if reply is None else ' '.join('{:02x}'.format(x) for x in bytearray(reply))))
+
+    s = Scheduler()
+    s.add(['engine_rpm', 'gear'], rate=10, priority=1)
+    s.add(['coolant_temp', 'transmission_temp'], rate=1)
+    s.once('EGS', b'\x04\x01', show_errors)
+    try:
+        s.run(show, duration=10)
+    finally:
+        print(s.report())
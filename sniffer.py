@@ -0,0 +1,228 @@
+#-*-coding:utf-8 -*-
+#
+# Passive K-line monitor - follows DS2 and KWP2000 traffic of other
+# testers and modules for hours, nothing is ever sent.
+#
+#   monitor = Sniffer(port='/dev/ttyUSB0')
+#   monitor.run(show)                        # show(timestamp, kind, frame)
+#
+#   python sniffer.py --port /dev/ttyUSB0 --duration 3600
+#
+# A frame is accepted where its length byte and XOR checksum agree: DS2
+# (address, size of the whole frame, ..., xor) or KWP2000 (b8, target,
+# source, size of the payload, ..., xor). After noise the monitor skips
+# one byte at a time until the next valid frame, the skipped bytes are
+# counted as corrupt. A partial frame that stalls for `gap` seconds is
+# given up the same way.
+#
+# Frames go into a ring buffer allocated once (capacity frames of up to
+# 260 bytes), a full day of traffic uses the same memory as the first
+# minute. take() hands out what arrived since the last call, frames
+# overwritten before anyone took them are counted as dropped.
+#
+
+import threading
+import time
+from array import array
+
+import serial
+
+from ds2 import DEFAULT_PORT, DEFAULT_BAUDRATE
+
+DS2 = 1
+KWP2000 = 2
+KINDS = { DS2 : 'DS2', KWP2000 : 'KWP' }
+
+# b8 tgt src len <255 bytes> xor
+MAX_FRAME = 4 + 255 + 1
+
+def _xor(view):
+    result = 0
+    for b in view:
+        result ^= b
+    return result
+
+class Sniffer(object):
+    def __init__(self, port=DEFAULT_PORT, bus=None, parity=serial.PARITY_EVEN, capacity=4096, gap=0.02):
+        if bus is None:
+            self._device = serial.Serial(port, DEFAULT_BAUDRATE, parity=parity, timeout=gap)
+        else:
+            # Listen on the port of an ECU object, it must not poll meanwhile
+            self._device = bus._device
+        self.capacity = capacity
+        self.gap = gap
+        self.frames = 0
+        self.bytes = 0
+        self.corrupt = 0
+        self.stalled = 0
+        self.dropped = 0
+        self.dropped_bytes = 0
+        # Ring of capacity slots, MAX_FRAME bytes each
+        self._data = bytearray(capacity * MAX_FRAME)
+        self._view = memoryview(self._data)
+        self._times = array('d', bytes(8 * capacity))
+        self._sizes = array('H', bytes(2 * capacity))
+        self._kinds = bytearray(capacity)
+        self._written = 0
+        # Sequence of the next frame for take(), None until somebody takes
+        self._taken = None
+        self._lock = threading.Lock()
+        # Receive buffer, at most one partial frame stays behind after parsing plus one read
+        self._buffer = bytearray(4 * MAX_FRAME)
+        self._buffer_view = memoryview(self._buffer)
+        self._start = 0
+        self._end = 0
+        self._running = False
+
+    def run(self, handler=None, duration=None):
+        """ handler(timestamp, kind, frame) for every frame, frame only valid during the call """
+        device = self._device
+        saved = device.timeout, device.inter_byte_timeout
+        device.timeout = self.gap
+        device.inter_byte_timeout = None
+        end = None if duration is None else time.monotonic() + duration
+        byte_time = 11.0 / device.baudrate # 8E1
+        self._running = True
+        try:
+            while self._running and (end is None or time.monotonic() < end):
+                data = device.read(min(max(device.in_waiting, 1), 2 * MAX_FRAME))
+                now = time.time()
+                if not data:
+                    # Bus idle, whatever is left will not become a frame
+                    if self._end > self._start:
+                        self._parse(now, byte_time, handler, final=True)
+                    continue
+                self._fill(data)
+                self._parse(now, byte_time, handler, final=False)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self._running = False
+            device.timeout, device.inter_byte_timeout = saved
+
+    def stop(self):
+        self._running = False
+
+    def _fill(self, data):
+        self.bytes += len(data)
+        if len(self._buffer) - self._end < len(data):
+            remaining = self._end - self._start
+            self._buffer[0:remaining] = self._buffer[self._start:self._end]
+            self._start, self._end = 0, remaining
+        self._buffer[self._end:self._end + len(data)] = data
+        self._end += len(data)
+
+    def _candidates(self, start, available):
+        """ (kind, size) the bytes at start could be, KWP2000 first """
+        buffer = self._buffer
+        if buffer[start] == 0xb8:
+            if available < 4:
+                yield KWP2000, None
+            else:
+                yield KWP2000, 4 + buffer[start + 3] + 1
+        size = buffer[start + 1]
+        if size >= 3:
+            yield DS2, size
+
+    def _parse(self, now, byte_time, handler, final):
+        view = self._buffer_view
+        while True:
+            available = self._end - self._start
+            if available < 2:
+                if final and available:
+                    self.stalled += available
+                    self._start = self._end
+                break
+            found = None
+            waiting = False
+            for kind, size in self._candidates(self._start, available):
+                if size is None or size > available:
+                    waiting = True
+                    if not final:
+                        # Still plausible, a shorter reading of the same bytes must not cut it short
+                        break
+                elif _xor(view[self._start:self._start + size]) == 0:
+                    found = kind, size
+                    break
+            if found is None:
+                if waiting and not final:
+                    break
+                # No frame starts here, resync one byte further
+                if waiting:
+                    self.stalled += 1
+                else:
+                    self.corrupt += 1
+                self._start += 1
+                continue
+            kind, size = found
+            frame = view[self._start:self._start + size]
+            self._start += size
+            # Start of the frame, the read that completed it holds it and whatever followed
+            timestamp = now - (self._end - self._start + size) * byte_time
+            self.frames += 1
+            self._store(timestamp, kind, frame)
+            if handler is not None:
+                handler(timestamp, kind, frame)
+        if self._start == self._end:
+            self._start = self._end = 0
+
+    def _store(self, timestamp, kind, frame):
+        with self._lock:
+            slot = self._written % self.capacity
+            if self._taken is not None and self._written - self._taken >= self.capacity:
+                self.dropped += 1
+                self.dropped_bytes += self._sizes[slot]
+                self._taken += 1
+            offset = slot * MAX_FRAME
+            self._data[offset:offset + len(frame)] = frame
+            self._times[slot] = timestamp
+            self._sizes[slot] = len(frame)
+            self._kinds[slot] = kind
+            self._written += 1
+
+    def take(self):
+        """ [(timestamp, kind, bytes)] received since the last take(), oldest first """
+        with self._lock:
+            frames = []
+            start = max(self._written - self.capacity, 0) if self._taken is None else self._taken
+            for sequence in range(start, self._written):
+                slot = sequence % self.capacity
+                offset = slot * MAX_FRAME
+                frames.append((self._times[slot], self._kinds[slot], bytes(self._view[offset:offset + self._sizes[slot]])))
+            self._taken = self._written
+        return frames
+
+    def recent(self, count=None):
+        """ The last count frames still in the ring (all if None), taken or not """
+        with self._lock:
+            stored = min(self._written, self.capacity)
+            count = stored if count is None else min(count, stored)
+            frames = []
+            for sequence in range(self._written - count, self._written):
+                slot = sequence % self.capacity
+                offset = slot * MAX_FRAME
+                frames.append((self._times[slot], self._kinds[slot], bytes(self._view[offset:offset + self._sizes[slot]])))
+        return frames
+
+    def summary(self):
+        return str(self.frames) + " frames, " + str(self.bytes) + " bytes, " + str(self.corrupt) + " corrupt bytes, " + \
+            str(self.stalled) + " stalled bytes, " + str(self.dropped) + " frames (" + str(self.dropped_bytes) + " bytes) dropped"
+
+def show(timestamp, kind, frame):
+    print("{:.3f} ".format(timestamp) + KINDS[kind] + " : " + ''.join('{:02x} '.format(x) for x in frame))
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Passive DS2 / KWP2000 monitor")
+    parser.add_argument('--port', default=DEFAULT_PORT)
+    parser.add_argument('--baudrate', type=int, default=DEFAULT_BAUDRATE)
+    parser.add_argument('--duration', type=float)
+    parser.add_argument('--quiet', action='store_true', help="only count, do not print frames")
+    args = parser.parse_args()
+
+    monitor = Sniffer(args.port)
+    monitor._device.baudrate = args.baudrate
+    print("Sniffing " + args.port + " at " + str(args.baudrate) + " baud ...")
+    monitor.run(None if args.quiet else show, args.duration)
+    print(monitor.summary())
@@ -0,0 +1,157 @@
+#-*-coding:utf-8 -*-
+#
+# Bus statistics - request / echo / reply timing and error counters kept by
+# every K_Line, per ECU address and service (first payload byte).
+#
+#   dme = ME72()
+#   ...
+#   print(dme.stats.dump())
+#
+#   DME 22 : 1200 requests, 0 timeouts, 0 echo timeouts, 3 busy, 0 negative, 0 checksum errors
+#            echo  p50 <= 5 ms, p99 <= 10 ms, max 6.2 ms
+#            reply p50 <= 50 ms, p99 <= 50 ms, max 31.0 ms
+#
+# Latencies go into fixed histogram buckets, recording one transaction is
+# a bisect and a few additions, so the counters are always on. ECUs on the
+# same K-line share one Stats like they share the pacer.
+#
+
+import threading
+import time
+from bisect import bisect_left
+
+# Bucket upper bounds in seconds, the last bucket takes everything above
+BUCKETS = (0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1.0, 2.0)
+
+class Histogram(object):
+    __slots__ = ('counts', 'count', 'sum', 'max')
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def add(self, seconds):
+        self.counts[bisect_left(BUCKETS, seconds)] += 1
+        self.count += 1
+        self.sum += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    def quantile(self, q):
+        """ Upper bound of the bucket holding the q quantile, None above the last bound """
+        if not self.count:
+            return None
+        rank = q * self.count
+        total = 0
+        for bound, count in zip(BUCKETS, self.counts):
+            total += count
+            if total >= rank:
+                return bound
+        return None
+
+    def cumulative(self):
+        """ [(upper bound, count at or below)], Prometheus style """
+        result = []
+        total = 0
+        for bound, count in zip(BUCKETS, self.counts):
+            total += count
+            result.append((bound, total))
+        return result
+
+    def format(self):
+        if not self.count:
+            return "-"
+        def bound(q):
+            value = self.quantile(q)
+            return "> " + "{:g}".format(BUCKETS[-1] * 1000) + " ms" if value is None else "<= " + "{:g}".format(value * 1000) + " ms"
+        return "p50 " + bound(0.5) + ", p99 " + bound(0.99) + ", max " + "{:.1f}".format(self.max * 1000) + " ms"
+
+class Counters(object):
+    __slots__ = ('requests', 'timeouts', 'echo_timeouts', 'busy', 'negative', 'checksum_errors', 'echo', 'reply')
+
+    def __init__(self):
+        self.requests = 0
+        self.timeouts = 0
+        self.echo_timeouts = 0
+        self.busy = 0
+        self.negative = 0
+        self.checksum_errors = 0
+        # Request on the wire to echo complete, echo to reply complete
+        self.echo = Histogram()
+        self.reply = Histogram()
+
+class Stats(object):
+    def __init__(self):
+        self.names = {}
+        self.counters = {}
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self.started = time.time()
+        self._lock = threading.Lock()
+
+    def _counters(self, address, service):
+        key = (address, service)
+        counters = self.counters.get(key)
+        if counters is None:
+            with self._lock:
+                counters = self.counters.setdefault(key, Counters())
+        return counters
+
+    def sent(self, size):
+        self.bytes_sent += size
+
+    def received(self, size):
+        self.bytes_received += size
+
+    def transaction(self, address, service, sent, echoed, replied, status=None):
+        """ perf_counter() times, echoed / replied None when nothing came back; status 'busy' or 'negative' """
+        counters = self._counters(address, service)
+        counters.requests += 1
+        if echoed is None:
+            counters.echo_timeouts += 1
+        else:
+            counters.echo.add(echoed - sent)
+        if replied is None:
+            counters.timeouts += 1
+        else:
+            counters.reply.add(replied - (sent if echoed is None else echoed))
+        if status == 'busy':
+            counters.busy += 1
+        elif status == 'negative':
+            counters.negative += 1
+
+    def checksum_error(self, address, service):
+        counters = self._counters(address, service)
+        counters.requests += 1
+        counters.checksum_errors += 1
+
+    def name(self, address):
+        return self.names.get(address) or '0x{:02x}'.format(address)
+
+    def items(self):
+        """ Snapshot of ((address, service), Counters), safe to call from another thread """
+        with self._lock:
+            return sorted(self.counters.items())
+
+    def reset(self):
+        with self._lock:
+            self.counters = {}
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self.started = time.time()
+
+    def dump(self):
+        lines = []
+        for (address, service), c in self.items():
+            title = self.name(address) + " " + '{:02x}'.format(service) + " : "
+            lines.append(title + str(c.requests) + " requests, " + str(c.timeouts) + " timeouts, " +
+                         str(c.echo_timeouts) + " echo timeouts, " + str(c.busy) + " busy, " +
+                         str(c.negative) + " negative, " + str(c.checksum_errors) + " checksum errors")
+            lines.append(" " * len(title) + "echo  " + c.echo.format())
+            lines.append(" " * len(title) + "reply " + c.reply.format())
+        elapsed = time.time() - self.started
+        lines.append("Bus : " + str(self.bytes_sent) + " bytes sent, " + str(self.bytes_received) + " bytes received in " +
+                     "{:.1f}".format(elapsed) + " sec")
+        return '\n'.join(lines)
@@ -0,0 +1,218 @@
+#-*-coding:utf-8 -*-
+#
+# Vehicle quick test - identify every E38 / E39 module address with a
+# short probe timeout, then read the fault memory of the ones present.
+#
+#   sweep = Sweep(vehicle='WBADN61000GM12345')
+#   for module in sweep.run():
+#       print(module)
+#
+#   python sweep.py --vehicle WBADN61000GM12345          # --full probes everything again
+#
+# An address is identified with DS2 (00) and, if that stays silent, with
+# KWP2000 (1a 80). A module only has to start its reply within
+# `probe_timeout`, any reply counts, a refusal too. What answered on which
+# protocol and what did not answer at all is kept per vehicle in
+# `cache` (JSON), later sweeps skip the absent addresses and try the
+# known protocol first.
+#
+
+import json
+import os
+import time
+
+import serial
+
+import ds2
+from ds2 import DEFAULT_PORT, ProtocolError
+
+NAMES = {
+    ds2.ZKE:            'ZKE',
+    ds2.DME:            'DME',
+    ds2.CENTRAL_BODY:   'CENTRAL_BODY',
+    ds2.EGS:            'EGS',
+    ds2.EWS:            'EWS',
+    ds2.DSC:            'DSC',
+    ds2.IHKA:           'IHKA',
+    ds2.RADIO:          'RADIO',
+    ds2.IKE:            'IKE',
+    ds2.AIRBAG:         'AIRBAG',
+    ds2.MID:            'MID',
+    ds2.LCM:            'LCM',
+    ds2.SZM:            'SZM',
+}
+
+ADDRESSES = sorted(NAMES)
+
+DS2 = 'DS2'
+KWP2000 = 'KWP2000'
+PROTOCOLS = [DS2, KWP2000]
+
+IDENTIFY = {
+    DS2:        b'\x00',
+    KWP2000:    b'\x1a\x80', # ReadEcuIdentification
+}
+
+FAULTS = {
+    DS2:        b'\x04\x01',
+    KWP2000:    b'\x18\x02\xff\xff', # ReadDiagnosticTroubleCodesByStatus, all groups
+}
+
+class Module(object):
+    __slots__ = ('address', 'protocol', 'ident', 'faults', 'fault_count')
+
+    def __init__(self, address, protocol, ident):
+        self.address = address
+        self.protocol = protocol
+        self.ident = ident
+        self.faults = None
+        self.fault_count = None
+
+    @property
+    def name(self):
+        return NAMES.get(self.address, hex(self.address))
+
+    def __repr__(self):
+        faults = "fault memory not read" if self.faults is None else \
+            (str(self.fault_count) + " faults" if self.fault_count is not None else "faults " + self.faults.hex())
+        return self.name + " (" + hex(self.address) + ") " + self.protocol + " : " + faults
+
+class Sweep(object):
+    def __init__(self, port=DEFAULT_PORT, parity=serial.PARITY_EVEN, vehicle='default', cache='sweep.json',
+                 probe_timeout=0.08, addresses=ADDRESSES):
+        self.ds2 = ds2.DS2(port=port, parity=parity)
+        self.kwp = ds2.KWP2000(bus=self.ds2)
+        self.vehicle = vehicle
+        self.cache = cache
+        self.probe_timeout = probe_timeout
+        self.addresses = addresses
+        self.probes = 0
+        self.skipped = []
+        self.absent = []
+        self.elapsed = None
+
+    def _line(self, protocol):
+        return self.kwp if protocol == KWP2000 else self.ds2
+
+    def _transfer(self, protocol, address, payload):
+        """ Reply frame from address, None if it stayed silent - nothing is printed """
+        line = self._line(protocol)
+        line.pacer.wait(line.timing.p3_min)
+        reply = None
+        try:
+            if protocol == KWP2000:
+                line._write(address, line.SOURCE, payload)
+            else:
+                line._write(address, payload)
+            reply = line._exchange(address, payload[0])
+        finally:
+            line.pacer.done(reply is not None)
+        if reply is None:
+            return None
+        sender = reply[2] if protocol == KWP2000 else reply[0]
+        if (protocol == KWP2000 and reply[0] != 0xb8) or sender != address:
+            return None
+        return bytes(reply)
+
+    def _probe(self, protocol, address):
+        line = self._line(protocol)
+        p2_max = line.timing.p2_max
+        line.timing.p2_max = self.probe_timeout
+        try:
+            self.probes += 1
+            try:
+                return self._transfer(protocol, address, IDENTIFY[protocol])
+            except ProtocolError:
+                # Somebody is talking, garbled, ask once more
+                self.probes += 1
+                return self._transfer(protocol, address, IDENTIFY[protocol])
+        except ProtocolError:
+            return None
+        finally:
+            line.timing.p2_max = p2_max
+
+    def _load(self):
+        if not os.path.exists(self.cache):
+            return {}
+        with open(self.cache) as f:
+            return json.load(f)
+
+    def _save(self, vehicles, present):
+        vehicles[self.vehicle] = {
+            'present': dict(('{:02x}'.format(m.address), m.protocol) for m in present),
+            'absent': ['{:02x}'.format(address) for address in sorted(self.absent + self.skipped)],
+            'updated': time.time(),
+        }
+        path = self.cache + '.tmp'
+        with open(path, 'w') as f:
+            json.dump(vehicles, f, indent=2, sort_keys=True)
+        os.replace(path, self.cache)
+
+    def run(self, full=False, faults=True):
+        """ Modules that answered, with their fault memory; full=True ignores the cached absent addresses """
+        started = time.monotonic()
+        vehicles = self._load()
+        known = vehicles.get(self.vehicle, {})
+        known_present = dict((int(address, 16), protocol) for address, protocol in known.get('present', {}).items())
+        known_absent = set(int(address, 16) for address in known.get('absent', []))
+        self.probes = 0
+        self.skipped = []
+        self.absent = []
+        present = []
+        for address in self.addresses:
+            if not full and address in known_absent:
+                self.skipped.append(address)
+                continue
+            protocols = PROTOCOLS
+            if address in known_present:
+                protocols = [known_present[address]] + [p for p in PROTOCOLS if p != known_present[address]]
+            for protocol in protocols:
+                reply = self._probe(protocol, address)
+                if reply is not None:
+                    present.append(Module(address, protocol, reply))
+                    break
+            else:
+                self.absent.append(address)
+        if faults:
+            for module in present:
+                self._faults(module)
+        self._save(vehicles, present)
+        self.elapsed = time.monotonic() - started
+        return present
+
+    def _faults(self, module):
+        try:
+            reply = self._transfer(module.protocol, module.address, FAULTS[module.protocol])
+        except ProtocolError:
+            return
+        # Refused (7f / status other than a0) is as good as no reply here
+        if reply is None or (module.protocol == KWP2000 and reply[4] == 0x7f) or \
+                (module.protocol == DS2 and reply[2] != 0xa0):
+            return
+        module.faults = reply
+        if module.protocol == KWP2000 and reply[4] == 0x58:
+            # 58 <count> (<dtc high> <dtc low> <status>)...
+            module.fault_count = reply[5]
+        elif module.address == ds2.EGS:
+            # a0 <count> ..., the GS 8.60.2 layout (ZF5HP24.decode)
+            module.fault_count = reply[3]
+
+    def summary(self):
+        return str(self.probes) + " probes, " + str(len(self.absent)) + " absent, " + str(len(self.skipped)) + \
+            " skipped (cached absent) in " + "{:.2f}".format(self.elapsed or 0.0) + " sec"
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Identify every module and read its fault memory")
+    parser.add_argument('--port', default=DEFAULT_PORT)
+    parser.add_argument('--vehicle', default='default', help="VIN or any name, absent modules are remembered per vehicle")
+    parser.add_argument('--cache', default='sweep.json')
+    parser.add_argument('--probe-timeout', type=float, default=0.08)
+    parser.add_argument('--full', action='store_true', help="probe cached absent addresses too")
+    args = parser.parse_args()
+
+    sweep = Sweep(args.port, vehicle=args.vehicle, cache=args.cache, probe_timeout=args.probe_timeout)
+    for module in sweep.run(full=args.full):
+        print(module)
+    print(sweep.summary())
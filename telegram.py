@@ -0,0 +1,323 @@
+#-*-coding:utf-8 -*-
+#
+# Table driven telegram decoder
+#
+# Measurement tables (TELEGRAM / BYTE / DATA_TYPE / FACT_A / FACT_B / MASK)
+# are compiled once into a struct.Struct plus scale / offset vectors, so a
+# reply is decoded with a single unpack_from call.
+#
+
+import re
+import struct
+import zipfile
+from collections import OrderedDict
+from xml.etree import ElementTree
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# DATA_TYPE column
+BIT = 1
+DATA_TYPES = {
+    1: 'B', # bit, selected by MASK / VALUE
+    2: 'B', # unsigned char
+    3: 'b', # signed char
+    5: 'H', # unsigned int
+    6: 'h', # signed int
+    7: 'h', # signed int
+}
+
+class Channel(object):
+    __slots__ = ('name', 'label', 'unit', 'byte', 'data_type', 'fact_a', 'fact_b', 'mask', 'value', 'text')
+
+    def __init__(self, name, byte, data_type, fact_a=1, fact_b=0, mask=0, value=0, unit='', label=None, text=None):
+        if data_type not in DATA_TYPES:
+            raise ValueError("unknown data type " + str(data_type) + " for " + name)
+        self.name = name
+        self.byte = byte
+        self.data_type = data_type
+        self.fact_a = fact_a
+        self.fact_b = fact_b
+        self.mask = mask
+        self.value = value
+        self.unit = unit
+        self.label = label if label else name
+        self.text = text
+
+    @property
+    def size(self):
+        return struct.calcsize('>' + DATA_TYPES[self.data_type])
+
+    def relocate(self, byte):
+        """ Same channel at another byte of another telegram """
+        return Channel(self.name, byte, self.data_type, self.fact_a, self.fact_b, self.mask, self.value,
+                       self.unit, self.label, self.text)
+
+    def format(self, value):
+        if value is None:
+            return "n/a"
+        if self.text is not None:
+            return str(self.text.get(value, value))
+        if self.unit:
+            return str(value) + " " + self.unit
+        return str(value)
+
+class Sample(object):
+    """ One decoded channel value, unformatted """
+    __slots__ = ('ecu', 'channel', 'value', 'unit', 'timestamp')
+
+    def __init__(self, ecu, channel, value, unit, timestamp):
+        self.ecu = ecu
+        self.channel = channel
+        self.value = value
+        self.unit = unit
+        self.timestamp = timestamp
+
+    def __repr__(self):
+        return "Sample(" + ', '.join(repr(getattr(self, k)) for k in self.__slots__) + ")"
+
+class Telegram(object):
+    def __init__(self, request, channels):
+        self.request = bytes(request)
+        self.channels = tuple(channels)
+
+        # One struct slot per distinct (byte, type), bit channels share their byte
+        slots = {}
+        for c in self.channels:
+            slots[(c.byte, DATA_TYPES[c.data_type])] = None
+        fmt = '>'
+        offset = 0
+        for i, (byte, code) in enumerate(sorted(slots)):
+            if byte < offset:
+                raise ValueError("overlapping field at byte " + str(byte))
+            fmt += 'x' * (byte - offset) + code
+            offset = byte + struct.calcsize('>' + code)
+            slots[(byte, code)] = i
+        self.struct = struct.Struct(fmt)
+        self._layout = sorted(slots)
+
+        self.slots = tuple(slots[(c.byte, DATA_TYPES[c.data_type])] for c in self.channels)
+        self.fact_a = tuple(c.fact_a for c in self.channels)
+        self.fact_b = tuple(c.fact_b for c in self.channels)
+        self.masks = tuple(c.mask for c in self.channels)
+        self.shifts = tuple(_lowest_bit(c.mask) for c in self.channels)
+        self.values = tuple(c.value for c in self.channels)
+        self.bits = tuple(c.data_type == BIT for c in self.channels)
+        plan = tuple(zip(self.slots, self.fact_a, self.fact_b, self.masks, self.shifts, self.values, self.bits))
+        # Plain scaled channels are decoded first, masked and bit channels after
+        # them, then put back into table order if the two were interleaved
+        self._linear = tuple((slot, a, b) for slot, a, b, mask, shift, value, bit in plan if not mask)
+        self._masked = tuple(p for p in plan if p[3])
+        order = [i for i, c in enumerate(self.channels) if not c.mask] + [i for i, c in enumerate(self.channels) if c.mask]
+        position = [0] * len(order)
+        for decoded, i in enumerate(order):
+            position[i] = decoded
+        self._order = None if order == sorted(order) else tuple(position)
+        self._short = {}
+
+    def decode(self, frame):
+        if len(frame) < self.struct.size:
+            return self._decode_short(frame)
+        raw = self.struct.unpack_from(frame)
+        result = [raw[slot] * a + b for slot, a, b in self._linear]
+        for slot, a, b, mask, shift, value, bit in self._masked:
+            r = raw[slot] & mask
+            if bit:
+                result.append(1 if r == value else 0)
+            else:
+                result.append((r >> shift) * a + b)
+        if self._order is not None:
+            return [result[i] for i in self._order]
+        return result
+
+    def decode_batch(self, frames, width=None):
+        """
+            Many replies of this telegram at once -> { channel name : numpy array }
+
+            frames is a list of same-length frames, a 2-D uint8 array or one
+            buffer of frames back to back (width bytes each, len(self) by default).
+            Channels beyond a shorter width come back as NaN, like _decode_short
+        """
+        if numpy is None:
+            raise ImportError("decode_batch needs numpy")
+        if isinstance(frames, numpy.ndarray):
+            data = numpy.ascontiguousarray(frames, dtype=numpy.uint8)
+            width = data.shape[1]
+        elif isinstance(frames, (bytes, bytearray, memoryview)):
+            data = frames
+            width = width or len(self)
+        else:
+            width = len(frames[0]) if frames else len(self)
+            if any(len(frame) != width for frame in frames):
+                raise ValueError("frames of different length")
+            data = b''.join(bytes(frame) for frame in frames)
+        # The struct layout as a structured dtype, one field per slot that fits the width
+        fits = [i for i, (byte, code) in enumerate(self._layout) if byte + struct.calcsize('>' + code) <= width]
+        dtype = numpy.dtype({
+            'names': ['s' + str(i) for i in fits],
+            'formats': ['>' + self._layout[i][1] for i in fits],
+            'offsets': [self._layout[i][0] for i in fits],
+            'itemsize': width,
+        })
+        records = numpy.frombuffer(data, dtype=dtype)
+        fits = set(fits)
+        result = {}
+        for c, slot, a, b, mask, shift, value, bit in zip(self.channels, self.slots, self.fact_a, self.fact_b,
+                                                          self.masks, self.shifts, self.values, self.bits):
+            if slot not in fits:
+                result[c.name] = numpy.full(len(records), numpy.nan)
+                continue
+            raw = records['s' + str(slot)]
+            if bit:
+                result[c.name] = ((raw & mask) == value).astype(numpy.uint8)
+            elif mask:
+                result[c.name] = ((raw & mask) >> shift) * a + b
+            else:
+                result[c.name] = raw * float(a) + b if (a != 1 or b != 0) else raw.astype(numpy.int64)
+        return result
+
+    def _decode_short(self, frame):
+        # Some ECU variants answer with a shorter block than the table
+        # describes, decode what is there and report the rest as None
+        length = len(frame)
+        if length not in self._short:
+            fits = [i for i, c in enumerate(self.channels) if c.byte + c.size <= length]
+            self._short[length] = (fits, Telegram(self.request, [self.channels[i] for i in fits]) if fits else None)
+        fits, telegram = self._short[length]
+        result = [None] * len(self.channels)
+        if telegram is not None:
+            for i, value in zip(fits, telegram.decode(frame)):
+                result[i] = value
+        return result
+
+    def __len__(self):
+        return self.struct.size
+
+class DecodeCache(object):
+    """
+        Bounded LRU of decoded replies keyed on (ecu, telegram, reply bytes) -
+        idle and status telegrams repeat byte for byte, they are decoded once.
+        The key holds the Telegram itself, a request redefined with another
+        channel set (ME72.define_identifier) never gets the old values back
+    """
+    def __init__(self, size=256):
+        self.size = size
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+
+    def decode(self, table, frame, ecu=None):
+        """ Same values as table.decode(frame), as a tuple """
+        key = (ecu, table, bytes(frame))
+        values = self._entries.get(key)
+        if values is not None:
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return values
+        self.misses += 1
+        values = tuple(table.decode(frame))
+        self._entries[key] = values
+        if len(self._entries) > self.size:
+            self._entries.popitem(last=False)
+        return values
+
+    def clear(self):
+        self._entries.clear()
+
+    def summary(self):
+        total = self.hits + self.misses
+        return str(self.hits) + " of " + str(total) + " decodes cached" + \
+            (" ({:.0f}%)".format(100.0 * self.hits / total) if total else "")
+
+def _lowest_bit(mask):
+    shift = 0
+    while mask and not (mask >> shift) & 1:
+        shift += 1
+    return shift
+
+def compile_table(rows):
+    """ rows of (request, Channel) -> { request payload : Telegram } """
+    groups = {}
+    order = []
+    for request, channel in rows:
+        request = bytes(request)
+        if request not in groups:
+            groups[request] = []
+            order.append(request)
+        # Tables repeat a channel once per job name, keep the first
+        if any(c.name == channel.name for c in groups[request]):
+            continue
+        groups[request].append(channel)
+    return dict((request, Telegram(request, groups[request])) for request in order)
+
+#
+# ME72KWP1.xlsx / GS8602.xlsx (decoded PRG tables)
+#
+
+_NS = '{http://schemas.openxmlformats.org/spreadsheetml/2006/main}'
+
+def read_xlsx(path):
+    """ First sheet as a list of { header : value } """
+    z = zipfile.ZipFile(path)
+    strings = []
+    if 'xl/sharedStrings.xml' in z.namelist():
+        for si in ElementTree.fromstring(z.read('xl/sharedStrings.xml')).iter(_NS + 'si'):
+            strings.append(''.join(t.text or '' for t in si.iter(_NS + 't')))
+    sheet = ElementTree.fromstring(z.read('xl/worksheets/sheet1.xml'))
+    header = None
+    result = []
+    for row in sheet.iter(_NS + 'row'):
+        cells = {}
+        for c in row.iter(_NS + 'c'):
+            column = re.match('[A-Z]+', c.get('r')).group(0)
+            v = c.find(_NS + 'v')
+            if c.get('t') == 'inlineStr':
+                cells[column] = ''.join(t.text or '' for t in c.iter(_NS + 't'))
+            elif v is None:
+                continue
+            elif c.get('t') == 's':
+                cells[column] = strings[int(v.text)]
+            else:
+                cells[column] = v.text
+        if header is None:
+            header = dict((k, _unquote(v)) for k, v in cells.items())
+        else:
+            result.append(dict((header[k], _unquote(v)) for k, v in cells.items() if k in header))
+    return result
+
+def _unquote(cell):
+    # 'HEAD "NAME"' / 'LINE "NMOT_W"' -> 'NAME' / 'NMOT_W'
+    m = re.match(r'^(?:HEAD|LINE) "(.*)"$', cell)
+    return m.group(1) if m else cell
+
+def _number(cell):
+    cell = (cell or '0').strip().replace(',', '.')
+    if cell.lower().startswith('0x'):
+        return int(cell, 16)
+    return float(cell) if ('.' in cell or 'e' in cell.lower()) else int(cell)
+
+def load_table(path, labels=None):
+    """ Measurement table (ME72KWP1.xlsx layout) -> { request payload : Telegram } """
+    labels = labels or {}
+    rows = []
+    for line in read_xlsx(path):
+        # Memory reads patch an address into the request (POS_ADR), they are
+        # one-off jobs rather than block telegrams
+        if _number(line.get('POS_ADR')):
+            continue
+        request = bytearray.fromhex(line['TELEGRAM'])
+        payload = request[4:4 + request[3]]
+        name = line['NAME']
+        channel = Channel(name,
+                          byte=_number(line['BYTE']),
+                          data_type=_number(line['DATA_TYPE']),
+                          fact_a=_number(line['FACT_A']),
+                          fact_b=_number(line['FACT_B']),
+                          mask=_number(line.get('MASK')),
+                          value=_number(line.get('VALUE')),
+                          unit=(line.get('MEAS') or '').strip(),
+                          label=labels.get(name, (line.get('LNAME') or '').strip()))
+        rows.append((payload, channel))
+    return compile_table(rows)
@@ -0,0 +1,135 @@
+#-*-coding:utf-8 -*-
+#
+# Triggered sampling - rules on decoded values raise the poll rate of the
+# related telegrams for a while and save what happened around the trigger.
+#
+#   s = Scheduler()
+#   s.add(['engine_rpm', 'gear', 'kickdown'], rate=2)
+#   t = Trigger(s, RULES, pre=5, post=5, directory='captures')
+#   t.run(duration=3600)
+#
+# Recent samples are kept in memory for `pre` seconds. When a rule fires
+# that window plus the next `post` seconds go to
+# <directory>/<rule>-<time>.jsonl, one { "t" : ..., signal : value, ... }
+# line per sample. Rules fire on the edge, they rearm once their condition
+# is false again.
+#
+
+import json
+import os
+import time
+from collections import deque
+
+class Rule(object):
+    def __init__(self, name, signal, above=None, below=None, equals=None, changed=False,
+                 rate=2, boost=10, hold=10.0, signals=None):
+        self.name = name
+        self.signal = signal
+        self.above = above
+        self.below = below
+        self.equals = equals
+        self.changed = changed
+        # Watch rate, rate while boosted and for how long
+        self.rate = rate
+        self.boost = boost
+        self.hold = hold
+        # Signals whose telegrams are boosted, the watched one by default
+        self.signals = signals or [signal]
+        self._last = None
+        self._armed = True
+
+    def check(self, value):
+        """ True on the sample the condition becomes true """
+        if value is None:
+            return False
+        if self.changed:
+            hit = self._last is not None and value != self._last
+            self._last = value
+            return hit
+        hit = (self.above is None or value > self.above) and \
+              (self.below is None or value < self.below) and \
+              (self.equals is None or value == self.equals)
+        if hit and self._armed:
+            self._armed = False
+            return True
+        if not hit:
+            self._armed = True
+        return False
+
+RULES = [
+    Rule('high_rpm', 'engine_rpm', above=5000, signals=['engine_rpm', 'air_mass', 'ignition_angle']),
+    Rule('gear_change', 'gear', changed=True, signals=['gear', 'turbine_rpm', 'output_rpm', 'engine_rpm']),
+    Rule('kickdown', 'kickdown', equals=1, signals=['kickdown', 'gear', 'engine_rpm']),
+] + [
+    Rule('knock_cyl' + str(cylinder), 'knock_cyl' + str(cylinder), above=1.5, rate=1,
+         signals=['knock_cyl' + str(cylinder), 'engine_rpm'])
+    for cylinder in range(1, 9)
+]
+
+class Capture(object):
+    def __init__(self, rule, timestamp, samples, until):
+        self.rule = rule
+        self.timestamp = timestamp
+        self.samples = samples
+        self.until = until
+
+class Trigger(object):
+    def __init__(self, scheduler, rules=RULES, pre=5.0, post=5.0, directory='.', handler=None):
+        self.scheduler = scheduler
+        self.rules = rules
+        self.pre = pre
+        self.post = post
+        self.directory = directory
+        self.handler = handler
+        self.fired = 0
+        self.saved = []
+        # Bounded by time, the maxlen only guards against a runaway rate
+        self._recent = deque(maxlen=100000)
+        self._captures = []
+        for rule in rules:
+            scheduler.add([rule.signal], rate=rule.rate)
+
+    def run(self, duration=None):
+        try:
+            self.scheduler.run(self.handle, duration)
+        finally:
+            self.flush()
+
+    def handle(self, timestamp, values):
+        """ Scheduler handler, hand it to Scheduler.run """
+        if self.handler is not None:
+            self.handler(timestamp, values)
+        self._recent.append((timestamp, values))
+        while self._recent and self._recent[0][0] < timestamp - self.pre:
+            self._recent.popleft()
+
+        for capture in list(self._captures):
+            capture.samples.append((timestamp, values))
+            if timestamp >= capture.until:
+                self._save(capture)
+                self._captures.remove(capture)
+
+        for rule in self.rules:
+            if rule.signal in values and rule.check(values[rule.signal]):
+                self.fired += 1
+                self.scheduler.boost(rule.signals, rule.boost, rule.hold)
+                self._captures.append(Capture(rule, timestamp, list(self._recent), timestamp + self.post))
+
+    def flush(self):
+        """ Save captures still collecting their post-trigger window """
+        for capture in self._captures:
+            self._save(capture)
+        self._captures = []
+
+    def _save(self, capture):
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        name = capture.rule.name + '-' + time.strftime('%Y%m%d-%H%M%S', time.localtime(capture.timestamp)) + \
+            '-{:03d}'.format(int(capture.timestamp * 1000) % 1000) + '.jsonl'
+        path = os.path.join(self.directory, name)
+        with open(path, 'w') as f:
+            for timestamp, values in capture.samples:
+                row = dict(values)
+                row['t'] = timestamp
+                f.write(json.dumps(row, sort_keys=True) + '\n')
+        self.saved.append(path)